@@ -0,0 +1,353 @@
+# Ingestion benchmark for ED_PersonalLogbook
+#  Generates synthetic journals and Market.json files, runs the ingestion
+#  path of logger.py against a temporary database and writes the results
+#  as JSON so that runs can be compared.
+#
+#  python benchmark.py --events 200000 --output before.json
+#  python benchmark.py --events 200000 --output after.json --baseline before.json
+
+import sys
+import json
+import gzip
+import time
+import random
+import tempfile
+import platform
+import argparse
+from pathlib import Path
+from collections import defaultdict
+from logging import getLogger, WARNING
+
+import logger as edlog
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# relative weight of each event in the synthetic journals
+DEFAULT_EVENT_MIX = {"FSDJump": 10, "Scan:AutoScan": 40, "Scan:Detailed": 15, "Docked": 3, "Location": 1, "Statistics": 0.2, "SupercruiseExit": 5, "StartJump": 10, "Music": 20, "ReceiveText": 15, "FuelScoop": 10}
+LIST_HANDLER = ["checkEvent", "updateSystem", "updateBody", "updateMarket", "updateFaction", "updateSystemFaction", "updateStatistics", "updateCommodity", "updateMarketPrice"]
+
+LIST_PLANETCLASS = ["Metal rich body", "High metal content body", "Rocky body", "Icy body", "Rocky ice body", "Earthlike body", "Water world", "Ammonia world", "Sudarsky class I gas giant", "Sudarsky class III gas giant"]
+LIST_STARCLASS = ["O", "B", "A", "F", "G", "K", "M", "L", "T", "Y", "N", "DA"]
+LIST_MATERIAL = ["iron", "nickel", "sulphur", "carbon", "chromium", "manganese", "phosphorus", "zinc", "germanium", "vanadium", "cadmium", "selenium", "niobium", "tin", "tungsten", "molybdenum", "yttrium", "arsenic", "mercury", "zirconium", "polonium", "ruthenium", "technetium", "antimony", "tellurium"]
+LIST_ECONOMY = ["Agriculture", "Extraction", "High Tech", "Industrial", "Military", "Refinery", "Service", "Terraforming", "Tourism"]
+LIST_GOVERNMENT = ["Anarchy", "Communism", "Confederacy", "Cooperative", "Corporate", "Democracy", "Dictatorship", "Feudal", "Patronage", "Theocracy"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ED_PersonalLogbook ingestion benchmark")
+    parser.add_argument("--events", type=int, default=100000, help="journal events to generate")
+    parser.add_argument("--files", type=int, default=20, help="journal files to split the events into")
+    parser.add_argument("--markets", type=int, default=50, help="Market.json files to ingest")
+    parser.add_argument("--commodities", type=int, default=400, help="commodities per Market.json")
+    parser.add_argument("--compression", choices=["none", *edlog.JOURNAL_DECOMPRESSOR], default="none", help="archive the journals compressed")
+    parser.add_argument("--mix", default=None, help="event weights, e.g. FSDJump=10,Scan:AutoScan=40,Music=20")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=1, help="journal parser processes")
+    parser.add_argument("--rebuild", action="store_true", help="import through the bulk rebuild path")
+    parser.add_argument("--no-latency", action="store_true", help="skip the instrumented per-handler pass")
+    parser.add_argument("--keep", action="store_true", help="keep the generated data and databases")
+    parser.add_argument("--output", default=None, help="write results as JSON")
+    parser.add_argument("--baseline", default=None, help="compare with the JSON results of an earlier run")
+    args = parser.parse_args()
+
+    getLogger().setLevel(WARNING)
+    mix = parseEventMix(args.mix) if args.mix else DEFAULT_EVENT_MIX
+
+    workdir = Path(tempfile.mkdtemp(prefix="edlog_bench_"))
+    print(f"generate synthetic data in {workdir}")
+    journalinfo = generateJournals(workdir / "journal", args.events, args.files, mix, args.seed)
+    if args.compression != "none":
+        journalinfo["compressed_bytes"] = compressJournals(workdir / "journal", args.compression)
+    marketfiles = generateMarkets(workdir / "market", args.markets, args.commodities, args.seed)
+
+    result = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "sqlite": edlog.sqlite3.sqlite_version,
+        "params": {"events": args.events, "files": args.files, "markets": args.markets, "commodities": args.commodities, "mix": mix, "seed": args.seed, "workers": args.workers, "compression": args.compression},
+    }
+
+    print("throughput pass")
+    result.update(runIngestion(workdir, workdir / "throughput.db", marketfiles, args.workers, args.rebuild))
+    result["journal"].update(journalinfo)
+    result["journal"]["events_per_sec"] = journalinfo["events"] / result["journal"]["seconds"]
+    result["journal"]["mb_per_sec"] = journalinfo["bytes"] / result["journal"]["seconds"] / 1e6
+    result["market"]["items_per_sec"] = args.markets * args.commodities / result["market"]["seconds"] if result["market"]["seconds"] > 0 else None
+
+    if not args.no_latency:
+        print("latency pass")
+        # handlers only run in this process
+        result.update(runLatency(workdir, workdir / "latency.db", marketfiles))
+
+    result["peak_rss_kb"] = getPeakRss()
+
+    printResult(result)
+    if args.baseline:
+        with open(args.baseline) as f:
+            printComparison(json.load(f), result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"results written to {args.output}")
+
+    if not args.keep:
+        for p in sorted(workdir.rglob("*"), reverse=True):
+            p.rmdir() if p.is_dir() else p.unlink()
+        workdir.rmdir()
+
+
+def parseEventMix(text:str) -> dict:
+    mix = {}
+    for item in text.split(","):
+        name, weight = item.split("=")
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+def runIngestion(workdir:Path, dbpath:Path, marketfiles:list, workers:int, rebuild:bool=False) -> dict:
+    """Run the bulk journal import and Market.json ingestion against a fresh database."""
+    openDatabase(workdir, dbpath)
+
+    t0 = time.perf_counter()
+    if rebuild:
+        edlog.rebuildDatabase(edlog.getEdLogList(workdir / "journal"), workers=workers)
+    else:
+        edlog.edjournalBulkReadLogs(edlog.getEdLogList(workdir / "journal"), workers=workers)
+    t1 = time.perf_counter()
+    for filepath in marketfiles:
+        edlog.readMarketJson(filepath)
+    t2 = time.perf_counter()
+
+    rows = countRows()
+    edlog.closeConnection()
+    return {
+        "journal": {"seconds": t1 - t0},
+        "market": {"files": len(marketfiles), "seconds": t2 - t1},
+        "rows": rows,
+        "db_bytes": dbpath.stat().st_size,
+    }
+
+
+def runLatency(workdir:Path, dbpath:Path, marketfiles:list) -> dict:
+    """Same ingestion with timing wrappers around checkEvent and the handlers."""
+    samples = defaultdict(list)
+    original = {name: getattr(edlog, name) for name in LIST_HANDLER}
+
+    def timed(name, func):
+        def wrapper(jsondata):
+            t0 = time.perf_counter_ns()
+            func(jsondata)
+            samples[name].append(time.perf_counter_ns() - t0)
+            if name == "checkEvent":
+                samples[f"event:{jsondata['event']}"].append(samples[name][-1])
+        return wrapper
+
+    flush = edlog.WriteBuffer.flush
+    def timedflush(self):
+        t0 = time.perf_counter_ns()
+        flush(self)
+        samples["WriteBuffer.flush"].append(time.perf_counter_ns() - t0)
+
+    openDatabase(workdir, dbpath)
+    try:
+        for name, func in original.items():
+            setattr(edlog, name, timed(name, func))
+        # checkEvent dispatches through functions bound from the module globals
+        edlog.bindEventHandlers()
+        edlog.WriteBuffer.flush = timedflush
+        edlog.edjournalBulkReadLogs(edlog.getEdLogList(workdir / "journal"))
+        for filepath in marketfiles:
+            edlog.readMarketJson(filepath)
+        edlog.closeConnection()
+    finally:
+        for name, func in original.items():
+            setattr(edlog, name, func)
+        edlog.bindEventHandlers()
+        edlog.WriteBuffer.flush = flush
+
+    return {"latency_us": {name: percentiles(values) for name, values in sorted(samples.items())}}
+
+
+def openDatabase(workdir:Path, dbpath:Path):
+    if dbpath.exists():
+        dbpath.unlink()
+    edlog.DB_NAME = str(dbpath)
+    edlog.PATH_EDLOG_DIR = str(workdir)
+    edlog.getConnection()
+
+
+def countRows() -> dict:
+    conn = edlog.getConnection()
+    edlog.flushWriteBuffer()
+    tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table' ORDER BY name")]
+    return {tbl: conn.execute(f"SELECT COUNT(*) FROM {tbl}").fetchone()[0] for tbl in tables}
+
+
+def percentiles(values:list) -> dict:
+    values = sorted(values)
+    def at(q):
+        return values[min(len(values) - 1, int(q * len(values)))] / 1000
+    return {"count": len(values), "p50": at(0.5), "p90": at(0.9), "p99": at(0.99), "max": values[-1] / 1000, "total_ms": sum(values) / 1e6}
+
+
+def getPeakRss() -> int:
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def printResult(result:dict):
+    journal = result["journal"]
+    market = result["market"]
+    print(f"journal: {journal['events']} events ({journal['handled']} handled) in {journal['files']} files, {journal['bytes'] / 1e6:.1f} MB")
+    if "compressed_bytes" in journal:
+        print(f"  compressed to {journal['compressed_bytes'] / 1e6:.1f} MB")
+    print(f"  {journal['seconds']:.2f} s, {journal['events_per_sec']:.0f} events/s, {journal['mb_per_sec']:.1f} MB/s")
+    if market["files"] > 0:
+        print(f"market: {market['files']} files in {market['seconds']:.2f} s, {market['items_per_sec']:.0f} items/s")
+    print(f"rows: {result['rows']}")
+    print(f"database: {result['db_bytes'] / 1e6:.1f} MB, peak RSS: {result['peak_rss_kb']} kB")
+    if "latency_us" in result:
+        print(f"{'latency [us]':32} {'count':>8} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>10} {'total ms':>10}")
+        for name, p in result["latency_us"].items():
+            print(f"{name:32} {p['count']:8} {p['p50']:8.1f} {p['p90']:8.1f} {p['p99']:8.1f} {p['max']:10.1f} {p['total_ms']:10.1f}")
+
+
+def printComparison(baseline:dict, result:dict):
+    print("compared with baseline:")
+    for section, key in [("journal", "events_per_sec"), ("journal", "seconds"), ("market", "items_per_sec"), ("market", "seconds")]:
+        old = baseline.get(section, {}).get(key)
+        new = result[section].get(key)
+        if old and new:
+            print(f"  {section}.{key}: {old:.2f} -> {new:.2f} ({(new / old - 1) * 100:+.1f}%)")
+    if baseline.get("peak_rss_kb") and result.get("peak_rss_kb"):
+        print(f"  peak_rss_kb: {baseline['peak_rss_kb']} -> {result['peak_rss_kb']}")
+
+
+# Synthetic data
+#  A commander jumps between systems, scans bodies, drops to stations and
+#  docks. Events are picked by weight; unhandled events (Music etc.) make up
+#  the share of the journal that the logger skips.
+def generateJournals(path_dir:Path, events:int, files:int, mix:dict, seed:int) -> dict:
+    rng = random.Random(seed)
+    path_dir.mkdir(parents=True, exist_ok=True)
+    factions = [makeFaction(rng, i) for i in range(max(20, events // 200))]
+    names = list(mix)
+    weights = [mix[name] for name in names]
+
+    state = {"system": None, "bodies": 0, "clock": 1704067200}
+    newSystem(rng, state, factions)
+    total = 0
+    handled = 0
+    size = 0
+    for fi in range(files):
+        count = events // files + (1 if fi < events % files else 0)
+        filename = path_dir / f"Journal.{time.strftime('%Y-%m-%dT%H%M%S', time.gmtime(state['clock']))}.01.log"
+        with open(filename, "w", encoding="utf-8", newline="") as f:
+            for i in range(count):
+                if i == 0:
+                    name = "Location"
+                else:
+                    name = rng.choices(names, weights)[0]
+                event = makeEvent(rng, name, state, factions)
+                line = json.dumps(event, ensure_ascii=False, separators=(",", ":")).replace('{"timestamp":', '{ "timestamp":', 1).replace(',"event":', ', "event":', 1)
+                f.write(line + "\r\n")
+                total += 1
+                handled += event["event"] in edlog.LIST_HANDLED_EVENT
+        size += filename.stat().st_size
+    return {"files": files, "events": total, "handled": handled, "bytes": size}
+
+def compressJournals(path_dir:Path, suffix:str) -> int:
+    """Replace the journals by compressed archives. Returns the archive bytes."""
+    size = 0
+    for filename in sorted(path_dir.glob("*.log")):
+        data = filename.read_bytes()
+        archive = filename.with_name(filename.name + suffix)
+        match suffix:
+            case ".gz":
+                archive.write_bytes(gzip.compress(data))
+            case ".zst":
+                archive.write_bytes(edlog.zstandard.ZstdCompressor().compress(data))
+        filename.unlink()
+        size += archive.stat().st_size
+    return size
+
+
+def makeFaction(rng:random.Random, i:int) -> dict:
+    return {"Name": f"Synthetic Faction {i}", "FactionState": "None", "Government": rng.choice(LIST_GOVERNMENT), "Influence": round(rng.random(), 6), "Allegiance": rng.choice(["Federation", "Empire", "Alliance", "Independent"]), "Happiness": "$Faction_HappinessBand2;", "Happiness_Localised": "Happy", "MyReputation": round(rng.uniform(-100, 100), 6)}
+
+
+def newSystem(rng:random.Random, state:dict, factions:list):
+    address = rng.randrange(1 << 40)
+    state["system"] = {
+        "StarSystem": f"Synthetic {address:x}",
+        "SystemAddress": address,
+        "StarPos": [round(rng.uniform(-1000, 1000), 5), round(rng.uniform(-300, 300), 5), round(rng.uniform(-1000, 1000), 5)],
+        "StarClass": rng.choice(LIST_STARCLASS),
+        "Factions": rng.sample(factions, rng.randint(0, 6)),
+    }
+    state["bodies"] = rng.randint(1, 40)
+
+
+def makeEvent(rng:random.Random, name:str, state:dict, factions:list) -> dict:
+    state["clock"] += rng.randint(1, 60)
+    timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(state["clock"]))
+    system = state["system"]
+    event, _, scantype = name.partition(":")
+    data = {"timestamp": timestamp, "event": event}
+    match event:
+        case "StartJump":
+            data.update(JumpType="Hyperspace", StarSystem=system["StarSystem"], SystemAddress=system["SystemAddress"], StarClass=system["StarClass"])
+        case "FSDJump" | "Location":
+            if event == "FSDJump":
+                newSystem(rng, state, factions)
+                system = state["system"]
+            data.update(StarSystem=system["StarSystem"], SystemAddress=system["SystemAddress"], StarPos=system["StarPos"], SystemAllegiance="Independent", SystemEconomy_Localised=rng.choice(LIST_ECONOMY), SystemSecondEconomy_Localised=rng.choice(LIST_ECONOMY), SystemGovernment_Localised=rng.choice(LIST_GOVERNMENT), SystemSecurity_Localised="Medium Security", Population=rng.randrange(10**9), Body=system["StarSystem"], BodyID=0, BodyType="Star")
+            if system["Factions"]:
+                data.update(Factions=[dict(fac, Influence=round(rng.random(), 6), ActiveStates=[{"State": "Boom"}]) for fac in system["Factions"]], SystemFaction={"Name": system["Factions"][0]["Name"]})
+            if rng.random() < 0.3:
+                data.update(ControllingPower="Synthetic Power", Powers=["Synthetic Power"], PowerplayState="Exploited")
+        case "Scan":
+            bodyid = rng.randint(1, state["bodies"])
+            data.update(ScanType=scantype or "AutoScan", BodyName=f"{system['StarSystem']} {bodyid}", BodyID=bodyid, Parents=[{"Planet": max(0, bodyid - 1)}, {"Null": 0}, {"Star": 0}][rng.randint(0, 2):], StarSystem=system["StarSystem"], SystemAddress=system["SystemAddress"], DistanceFromArrivalLS=round(rng.uniform(0, 50000), 6), TidalLock=rng.random() < 0.3, TerraformState=rng.choice(["", "", "Terraformable"]), PlanetClass=rng.choice(LIST_PLANETCLASS), Atmosphere="", AtmosphereType="None", Volcanism="", MassEM=round(rng.uniform(0.01, 300), 6), Radius=round(rng.uniform(1e5, 7e7), 3), SurfaceGravity=round(rng.uniform(0.1, 30), 6), SurfaceTemperature=round(rng.uniform(20, 2000), 6), SurfacePressure=0.0, Landable=rng.random() < 0.4, Materials=[{"Name": mat, "Percent": round(rng.uniform(0.1, 25), 6)} for mat in rng.sample(LIST_MATERIAL, 6)], Composition={"Ice": 0.0, "Rock": 0.67, "Metal": 0.33}, SemiMajorAxis=round(rng.uniform(1e8, 1e12), 3), Eccentricity=round(rng.random() / 10, 6), OrbitalInclination=round(rng.uniform(-10, 10), 6), Periapsis=round(rng.uniform(0, 360), 6), OrbitalPeriod=round(rng.uniform(1e5, 1e8), 3), AscendingNode=round(rng.uniform(-180, 180), 6), MeanAnomaly=round(rng.uniform(0, 360), 6), RotationPeriod=round(rng.uniform(1e4, 1e7), 3), AxialTilt=round(rng.uniform(-1, 1), 6), WasDiscovered=rng.random() < 0.8, WasMapped=rng.random() < 0.3)
+        case "SupercruiseExit":
+            data.update(StarSystem=system["StarSystem"], SystemAddress=system["SystemAddress"], Body=f"{system['StarSystem']} Station", BodyID=state["bodies"] + 1, BodyType="Station")
+        case "Docked":
+            faction = system["Factions"][0]["Name"] if system["Factions"] else "Synthetic Faction 0"
+            data.update(StationName=f"{system['StarSystem']} Station", StationType="Coriolis", StarSystem=system["StarSystem"], SystemAddress=system["SystemAddress"], MarketID=system["SystemAddress"] % 10**9 + 3000000000, StationFaction={"Name": faction}, StationGovernment_Localised=rng.choice(LIST_GOVERNMENT), StationServices=["dock", "autodock", "commodities", "refuel", "repair"], StationEconomy_Localised=rng.choice(LIST_ECONOMY), DistFromStarLS=round(rng.uniform(10, 5000), 6), LandingPads={"Small": 4, "Medium": 6, "Large": rng.randint(0, 4)})
+        case "Statistics":
+            data.update(Bank_Account={"Current_Wealth": rng.randrange(10**10), "Spent_On_Ships": rng.randrange(10**9)}, Combat={"Bounties_Claimed": rng.randrange(1000)}, Exploration={"Systems_Visited": rng.randrange(10**5), "Total_Hyperspace_Jumps": rng.randrange(10**5)})
+        case "Music":
+            data.update(MusicTrack=rng.choice(["Exploration", "Supercruise", "DestinationFromHyperspace"]))
+        case "ReceiveText":
+            data.update(From="", Message="$COMMS_entered:#name=Synthetic;", Message_Localised="Entered Channel: Synthetic", Channel="npc")
+        case "FuelScoop":
+            data.update(Scooped=round(rng.uniform(0, 5), 6), Total=round(rng.uniform(0, 32), 6))
+    return data
+
+
+def generateMarkets(path_dir:Path, markets:int, commodities:int, seed:int) -> list:
+    rng = random.Random(seed + 1)
+    path_dir.mkdir(parents=True, exist_ok=True)
+    listMarket = []
+    for mi in range(markets):
+        items = []
+        for ci in range(commodities):
+            producer = rng.random() < 0.4
+            mean = rng.randint(100, 20000)
+            items.append({"id": 128049152 + ci, "Name": f"$synthetic{ci}_name;", "Name_Localised": f"Synthetic Commodity {ci}", "Category": "$MARKET_category_synthetic;", "Category_Localised": "Synthetic", "BuyPrice": mean - rng.randint(0, mean // 4) if producer else 0, "SellPrice": mean + rng.randint(-mean // 4, mean // 4), "MeanPrice": mean, "StockBracket": 2 if producer else 0, "DemandBracket": 0 if producer else 2, "Stock": rng.randint(1, 50000) if producer else 0, "Demand": 0 if producer else rng.randint(1, 50000), "Consumer": not producer, "Producer": producer, "Rare": False})
+        data = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(1704067200 + mi * 600)), "event": "Market", "MarketID": 3200000000 + mi, "StationName": f"Synthetic Station {mi}", "StationType": "Coriolis", "StarSystem": f"Synthetic Market System {mi}", "Items": items}
+        filepath = path_dir / f"Market.{mi:05d}.json"
+        with open(filepath, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=1)
+        listMarket.append(filepath)
+    return listMarket
+
+
+if __name__ == "__main__":
+    main()
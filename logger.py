@@ -1,18 +1,39 @@
 # Personal logger script for Elite:Dangerous
 # TestVersion
 
+import os
 import json
+import gzip
 import sqlite3
 import datetime
+import argparse
+import time
 import re
+import math
+import signal
+import asyncio
+import threading
 from bidict import bidict
-from typing import List, Dict, Tuple
-from watchfiles import watch
+from typing import List, Dict, Tuple, NamedTuple, Callable
+from collections import Counter, deque
+from contextlib import contextmanager
+from functools import wraps
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from operator import itemgetter
+from watchfiles import awatch, Change
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 from pprint import pformat, pprint
 from pathlib import Path
-from logging import basicConfig, getLogger, DEBUG, ERROR
+from logging import basicConfig, getLogger, DEBUG, INFO, ERROR
 
-basicConfig(level=DEBUG)
 logger = getLogger(__name__)
 
 PATH_EDLOG_DIR='/mnt/DATA/SteamLibrary/steamapps/compatdata/359320/pfx/drive_c/users/steamuser/Saved Games/Frontier Developments/Elite Dangerous/'
@@ -52,6 +73,42 @@ sqlite3.register_converter("date", convert_date)
 sqlite3.register_converter("datetime", convert_datetime)
 sqlite3.register_converter("timestamp", convert_timestamp)
 
+def parseTimestamp(value) -> int:
+    """Journal timestamp such as "2024-01-01T00:00:00Z" as Unix epoch seconds.
+    Timestamps without a zone are UTC like the journal. Integers pass through."""
+    if value is None or isinstance(value, int):
+        return value
+    try:
+        dt = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        logger.error(f"invalid timestamp: {value}")
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return int(dt.timestamp())
+
+def parseRawTimestamp(value) -> int:
+    """parseTimestamp of a timestamp still held as the raw bytes of a journal line.
+    Readers keep the timestamps of skipped lines raw and only parse the ones they keep."""
+    if isinstance(value, bytes):
+        return parseTimestamp(value.decode())
+    return value
+
+def toEpoch(value) -> int:
+    """Bound of a time-window query as Unix epoch seconds, from an epoch
+    integer, a datetime or date (UTC unless zoned) or an ISO 8601 string."""
+    match value:
+        case None | int():
+            return value
+        case datetime.datetime():
+            if value.tzinfo is None:
+                value = value.replace(tzinfo=datetime.timezone.utc)
+            return int(value.timestamp())
+        case datetime.date():
+            return int(datetime.datetime(value.year, value.month, value.day, tzinfo=datetime.timezone.utc).timestamp())
+        case _:
+            return parseTimestamp(str(value))
+
 # Query to create tables
 #  system_tbl: StarSystem
 #  body_tbl: body_type=(star/planet/belt/station)
@@ -75,40 +132,231 @@ QUERY_CREATE_TABLE = [
 
     "CREATE TABLE IF NOT EXISTS market_price_tbl(market_id INTEGER, commodity_id INTEGER, buyprice INTEGER, sellprice INTEGER, stockbracket INTEGER, demandbracket INTEGER, stock INTEGER, demand INTEGER, updated_at INTEGER, PRIMARY KEY(market_id, commodity_id)) WITHOUT ROWID",
 
-    "CREATE TABLE IF NOT EXISTS faction_tbl(id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL, allegiance TEXT, government TEXT, myreputation REAL, updated_at INTEGER)",
+    # time of the latest Market.json of each market, written even when no price changed
+    "CREATE TABLE IF NOT EXISTS market_seen_tbl(market_id INTEGER PRIMARY KEY, seen_at INTEGER)",
 
-    "CREATE INDEX IF NOT EXISTS faction_tbl_name_idx ON faction_tbl(name)",
+    # price changes of market_price_tbl, written by triggers
+    "CREATE TABLE IF NOT EXISTS market_price_history_tbl(commodity_id INTEGER, market_id INTEGER, updated_at INTEGER, buyprice INTEGER, sellprice INTEGER, stockbracket INTEGER, demandbracket INTEGER, stock INTEGER, demand INTEGER, PRIMARY KEY(commodity_id, market_id, updated_at)) WITHOUT ROWID",
+
+    "CREATE TABLE IF NOT EXISTS faction_tbl(id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL, allegiance TEXT, government TEXT, myreputation REAL, updated_at INTEGER)",
 
     "CREATE TABLE IF NOT EXISTS system_faction_tbl(faction_id INTEGER, system_id INTEGER, state BLOB NOT NULL DEFAULT (jsonb('{}')), influence REAL, happiness TEXT, updated_at INTEGER, PRIMARY KEY(faction_id, system_id)) WITHOUT ROWID",
 
     "CREATE TABLE IF NOT EXISTS commodity_tbl(id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL, category TEXT, israre INTEGER)",
 
-    "CREATE TABLE IF NOT EXISTS statistics_tbl(id INTEGER PRIMARY KEY, updated_at INTEGER UNIQUE NOT NULL, detail BLOB NOT NULL DEFAULT (jsonb('{}')) )"
+    "CREATE TABLE IF NOT EXISTS statistics_tbl(id INTEGER PRIMARY KEY, updated_at INTEGER UNIQUE NOT NULL, detail BLOB NOT NULL DEFAULT (jsonb('{}')) )",
+
+    "CREATE TABLE IF NOT EXISTS ingest_state_tbl(path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, offset INTEGER, firstevent_at INTEGER, lastevent_at INTEGER) WITHOUT ROWID",
+
+    # Materials of body_tbl.detail, one row per material and body, written by triggers.
+    # Keyed by material first for lookups; triggers find a body's rows from its old detail.
+    "CREATE TABLE IF NOT EXISTS body_material_tbl(material TEXT, system_id INTEGER, body_id INTEGER, percent REAL, PRIMARY KEY(material, system_id, body_id)) WITHOUT ROWID",
+
+    # Closure of the Parents of body_tbl.detail, one row per body and ancestor, written by triggers.
+    # depth 1 is the body orbited directly; orbittype is Star, Planet or Null (barycentre) of the ancestor.
+    # Ids listed twice in Parents keep their outermost entry.
+    "CREATE TABLE IF NOT EXISTS body_ancestor_tbl(system_id INTEGER, ancestor_id INTEGER, body_id INTEGER, depth INTEGER, orbittype TEXT, PRIMARY KEY(system_id, ancestor_id, body_id)) WITHOUT ROWID"
+    ];
+
+# Generated columns
+#  Fields of JSONB detail columns exposed as virtual columns:
+#  (table, column, type, JSON path in detail)
+#  Each index in LIST_DETAIL_INDEX costs a decode of detail per write.
+LIST_DETAIL_COLUMN = [
+    ("body_tbl", "planetclass", "TEXT", "$.PlanetClass"),
+    ("body_tbl", "landable", "INTEGER", "$.Landable"),
+    ("body_tbl", "terraformstate", "TEXT", "$.TerraformState"),
+    ("body_tbl", "distancefromarrivalls", "REAL", "$.DistanceFromArrivalLS"),
+    ("system_tbl", "controllingpower", "TEXT", "$.ControllingPower"),
+    ("system_tbl", "powerplaystate", "TEXT", "$.PowerplayState"),
+    ];
+LIST_DETAIL_INDEX = [
+    ("body_tbl", ("planetclass", "distancefromarrivalls")),
+    ("body_tbl", ("terraformstate",)),
+    ("system_tbl", ("controllingpower",)),
+    ];
+
+# Query to create secondary indexes and triggers
+#  A rebuild runs these once after loading all data.
+QUERY_CREATE_INDEX = [
+    "CREATE INDEX IF NOT EXISTS faction_tbl_name_idx ON faction_tbl(name)",
+
+    "CREATE INDEX IF NOT EXISTS market_tbl_system_idx ON market_tbl(system_id)",
+
+    "CREATE INDEX IF NOT EXISTS market_price_tbl_commodity_idx ON market_price_tbl(commodity_id)",
+
+    *[f"CREATE INDEX IF NOT EXISTS {tbl}_{cols[0]}_idx ON {tbl}({', '.join(cols)})" for tbl, cols in LIST_DETAIL_INDEX],
+
+    "CREATE TRIGGER IF NOT EXISTS body_material_insert AFTER INSERT ON body_tbl BEGIN INSERT OR REPLACE INTO body_material_tbl SELECT m.value->>'Name', new.system_id, new.body_id, m.value->>'Percent' FROM json_each(new.detail, '$.Materials') AS m WHERE m.value->>'Name' IS NOT NULL; END",
+
+    "CREATE TRIGGER IF NOT EXISTS body_material_update AFTER UPDATE OF detail ON body_tbl WHEN jsonb_extract(new.detail, '$.Materials') IS NOT jsonb_extract(old.detail, '$.Materials') BEGIN DELETE FROM body_material_tbl WHERE material IN (SELECT m.value->>'Name' FROM json_each(old.detail, '$.Materials') AS m) AND system_id=new.system_id AND body_id=new.body_id; INSERT OR REPLACE INTO body_material_tbl SELECT m.value->>'Name', new.system_id, new.body_id, m.value->>'Percent' FROM json_each(new.detail, '$.Materials') AS m WHERE m.value->>'Name' IS NOT NULL; END",
+
+    "CREATE TRIGGER IF NOT EXISTS body_material_delete AFTER DELETE ON body_tbl BEGIN DELETE FROM body_material_tbl WHERE material IN (SELECT m.value->>'Name' FROM json_each(old.detail, '$.Materials') AS m) AND system_id=old.system_id AND body_id=old.body_id; END",
+
+    # fill body_material_tbl of databases created before it, or rebuilt
+    "INSERT OR IGNORE INTO body_material_tbl SELECT m.value->>'Name', b.system_id, b.body_id, m.value->>'Percent' FROM body_tbl AS b, json_each(b.detail, '$.Materials') AS m WHERE m.value->>'Name' IS NOT NULL AND NOT EXISTS(SELECT 1 FROM body_material_tbl)",
+
+    "CREATE INDEX IF NOT EXISTS body_ancestor_tbl_body_idx ON body_ancestor_tbl(system_id, body_id, depth)",
+
+    "CREATE TRIGGER IF NOT EXISTS body_ancestor_insert AFTER INSERT ON body_tbl BEGIN INSERT OR REPLACE INTO body_ancestor_tbl SELECT new.system_id, t.value, new.body_id, max(p.key)+1, t.key FROM json_each(new.detail, '$.Parents') AS p, json_each(p.value) AS t GROUP BY t.value; END",
+
+    "CREATE TRIGGER IF NOT EXISTS body_ancestor_update AFTER UPDATE OF detail ON body_tbl WHEN jsonb_extract(new.detail, '$.Parents') IS NOT jsonb_extract(old.detail, '$.Parents') BEGIN DELETE FROM body_ancestor_tbl WHERE system_id=new.system_id AND body_id=new.body_id; INSERT OR REPLACE INTO body_ancestor_tbl SELECT new.system_id, t.value, new.body_id, max(p.key)+1, t.key FROM json_each(new.detail, '$.Parents') AS p, json_each(p.value) AS t GROUP BY t.value; END",
+
+    "CREATE TRIGGER IF NOT EXISTS body_ancestor_delete AFTER DELETE ON body_tbl BEGIN DELETE FROM body_ancestor_tbl WHERE system_id=old.system_id AND body_id=old.body_id; END",
+
+    # fill body_ancestor_tbl of databases created before it, or rebuilt
+    "INSERT OR REPLACE INTO body_ancestor_tbl SELECT b.system_id, t.value, b.body_id, max(p.key)+1, t.key FROM body_tbl AS b, json_each(b.detail, '$.Parents') AS p, json_each(p.value) AS t WHERE NOT EXISTS(SELECT 1 FROM body_ancestor_tbl) GROUP BY b.system_id, b.body_id, t.value",
+
+    # time-window queries
+    "CREATE INDEX IF NOT EXISTS system_tbl_lastarrived_idx ON system_tbl(lastarrived_at)",
+
+    "CREATE INDEX IF NOT EXISTS system_tbl_updated_idx ON system_tbl(updated_at)",
+
+    "CREATE INDEX IF NOT EXISTS body_tbl_updated_idx ON body_tbl(updated_at)",
+
+    "CREATE INDEX IF NOT EXISTS market_tbl_updated_idx ON market_tbl(updated_at)",
+
+    "CREATE INDEX IF NOT EXISTS market_price_tbl_updated_idx ON market_price_tbl(updated_at)",
+
+    "CREATE INDEX IF NOT EXISTS market_seen_tbl_seen_idx ON market_seen_tbl(seen_at)",
+
+    # fill market_seen_tbl of databases created before it with the latest price change
+    "INSERT INTO market_seen_tbl SELECT market_id, max(updated_at) FROM market_price_tbl WHERE NOT EXISTS(SELECT 1 FROM market_seen_tbl) GROUP BY market_id",
+
+    "CREATE INDEX IF NOT EXISTS system_faction_tbl_updated_idx ON system_faction_tbl(updated_at)",
+
+    # spatial index of system_tbl positions, kept in sync by triggers
+    "CREATE VIRTUAL TABLE IF NOT EXISTS system_rtree USING rtree(id, minx, maxx, miny, maxy, minz, maxz)",
+
+    "CREATE TRIGGER IF NOT EXISTS system_rtree_insert AFTER INSERT ON system_tbl WHEN new.posx IS NOT NULL BEGIN DELETE FROM system_rtree WHERE id=new.id; INSERT INTO system_rtree VALUES(new.id, new.posx, new.posx, new.posy, new.posy, new.posz, new.posz); END",
+
+    "CREATE TRIGGER IF NOT EXISTS system_rtree_update AFTER UPDATE OF posx, posy, posz ON system_tbl WHEN new.posx IS NOT NULL AND (new.posx IS NOT old.posx OR new.posy IS NOT old.posy OR new.posz IS NOT old.posz) BEGIN DELETE FROM system_rtree WHERE id=new.id; INSERT INTO system_rtree VALUES(new.id, new.posx, new.posx, new.posy, new.posy, new.posz, new.posz); END",
+
+    "CREATE TRIGGER IF NOT EXISTS system_rtree_delete AFTER DELETE ON system_tbl BEGIN DELETE FROM system_rtree WHERE id=old.id; END",
+
+    # fill the spatial index of databases created before it, or rebuilt
+    "INSERT INTO system_rtree SELECT id, posx, posx, posy, posy, posz, posz FROM system_tbl WHERE posx IS NOT NULL AND NOT EXISTS(SELECT 1 FROM system_rtree)",
+
+    "CREATE TRIGGER IF NOT EXISTS market_price_history_insert AFTER INSERT ON market_price_tbl BEGIN INSERT OR IGNORE INTO market_price_history_tbl VALUES(new.commodity_id, new.market_id, new.updated_at, new.buyprice, new.sellprice, new.stockbracket, new.demandbracket, new.stock, new.demand); END",
+
+    "CREATE TRIGGER IF NOT EXISTS market_price_history_update AFTER UPDATE ON market_price_tbl BEGIN INSERT OR IGNORE INTO market_price_history_tbl VALUES(new.commodity_id, new.market_id, new.updated_at, new.buyprice, new.sellprice, new.stockbracket, new.demandbracket, new.stock, new.demand); END",
+
+    # start the history of databases created before it with the current prices
+    "INSERT INTO market_price_history_tbl SELECT commodity_id, market_id, updated_at, buyprice, sellprice, stockbracket, demandbracket, stock, demand FROM market_price_tbl WHERE NOT EXISTS(SELECT 1 FROM market_price_history_tbl)"
+    ];
+
+# Schema migrations
+#  QUERY_MIGRATION[n] upgrades a database from PRAGMA user_version n to n+1.
+#  New databases are created at SCHEMA_VERSION.
+QUERY_MIGRATION = [
+    # 0 -> 1: ISO 8601 timestamps to Unix epoch seconds. The history goes
+    # first so the rows its trigger adds for market_price_tbl already exist.
+    [f"UPDATE {tbl} SET {col}=CAST(strftime('%s', {col}) AS INTEGER) WHERE typeof({col})='text'" for tbl, col in [
+        ("market_price_history_tbl", "updated_at"), ("market_price_tbl", "updated_at"),
+        ("system_tbl", "lastarrived_at"), ("system_tbl", "updated_at"), ("body_tbl", "updated_at"), ("market_tbl", "updated_at"),
+        ("faction_tbl", "updated_at"), ("system_faction_tbl", "updated_at"), ("statistics_tbl", "updated_at"),
+        ("ingest_state_tbl", "firstevent_at"), ("ingest_state_tbl", "lastevent_at")]],
+    ];
+SCHEMA_VERSION = len(QUERY_MIGRATION)
+
+# Tables rebuilt from journals. The other tables come from Market.json and
+# are copied over from the live database on a rebuild.
+LIST_JOURNAL_TABLE = ["system_tbl", "body_tbl", "body_material_tbl", "body_ancestor_tbl", "market_tbl", "faction_tbl", "system_faction_tbl", "statistics_tbl", "ingest_state_tbl"]
+
+# Rebuild
+#  A rebuild loads into a fresh file next to the live database without
+#  journaling or fsync and with a large page cache, builds the secondary
+#  indexes at the end and then renames it over the live database. A crash
+#  leaves the live database untouched.
+REBUILD_SUFFIX = ".rebuild"
+REBUILD_CACHE_KB = 512 * 1024
+QUERY_REBUILD_PRAGMA = [
+    "PRAGMA journal_mode=OFF",
+    "PRAGMA synchronous=OFF",
+    f"PRAGMA cache_size=-{REBUILD_CACHE_KB}",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA locking_mode=EXCLUSIVE",
+    ];
+
+# Connections
+#  The database runs in WAL mode with a single writer connection
+#  (getConnection) and a pool of read-only connections (readConnection).
+#  Readers see the last committed snapshot and neither block nor are blocked
+#  by the writer. Automatic checkpoints are off: checkpointWal runs after the
+#  writer commits, so the WAL is bounded by the size of one batch.
+READER_POOL_SIZE = 4
+BUSY_TIMEOUT_MS = 5000
+WAL_CHECKPOINT_BYTES = 4 * 1024 * 1024
+WAL_TRUNCATE_BYTES = 64 * 1024 * 1024
+QUERY_WRITER_PRAGMA = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA wal_autocheckpoint=0",
+    f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}",
+    ];
+QUERY_READER_PRAGMA = [
+    "PRAGMA query_only=ON",
+    f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}",
     ];
 
 def main():
     print("Personal logger script for Elite:Dangerous")
     print("ver 0.01")
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rebuild", action="store_true", help="rebuild the database from all journals into a new file and swap it in")
+    parser.add_argument("--tail", action="store_true", help="keep following the journal directory after the import")
+    parser.add_argument("--json-decoder", choices=["auto", "json", "orjson"], default="auto", help="JSON decoder of journal lines (default: orjson if installed)")
+    parser.add_argument("--workers", type=int, default=None, help="journal parser processes (default: CPU count with --rebuild, otherwise 1)")
+    parser.add_argument("--metrics", action="store_true", help="time parsing, handlers, SQL and commits and print a summary (SIGUSR1 prints it while tailing)")
+    parser.add_argument("--verbose", action="store_true", help="debug logging")
+    args = parser.parse_args()
+    if args.workers is None:
+        args.workers = os.cpu_count() if args.rebuild else 1
+
+    basicConfig(level=DEBUG if args.verbose else INFO)
+    setJsonDecoder(args.json_decoder)
+    if args.metrics:
+        enableMetrics()
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: print(formatMetrics()))
+
+    edlogs = getEdLogList(PATH_EDLOG_DIR)
+    if args.rebuild:
+        rebuildDatabase(edlogs, workers=args.workers)
+
     conn = getConnection()
     if conn is None:
         exit()
 
-    edlogs = getEdLogList(PATH_EDLOG_DIR)
-    edjournalBulkReadLogs(edlogs)
+    edjournalBulkReadLogs(edlogs, workers=args.workers)
 
     readMarketJson()
     commoditytbl = getCommodityBidict()
     # pprint(commoditytbl[1])
 
+    if args.tail:
+        try:
+            edjournalTail(PATH_EDLOG_DIR)
+        except KeyboardInterrupt:
+            pass
+
+    logger.info(f"upsert plan cache: {getUpsertPlanStats()}")
+    logger.info(f"event filter: {getEventFilterStats()}")
+    logger.info(f"writes: {getWriteStats()}")
     closeConnection()
+    if args.metrics:
+        print(formatMetrics())
 
 _dbconnection = None
 def getConnection():
     global _dbconnection
 
     if _dbconnection is None:
-        _dbconnection = sqlite3.connect(DB_NAME, detect_types=sqlite3.PARSE_DECLTYPES)
+        # the tail pipeline hands the connection to its writer thread
+        _dbconnection = sqlite3.connect(DB_NAME, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        for query in QUERY_WRITER_PRAGMA:
+            _dbconnection.execute(query)
         cur = _dbconnection.cursor()
 
         cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table';")
@@ -116,43 +364,230 @@ def getConnection():
         cur.close()
 
         if table_cnt == 0:
-            # create tables
             print("Create Tables...")
-            _dbconnection.execute("BEGIN")
-            for query in QUERY_CREATE_TABLE:
-                _dbconnection.execute(query)
-            _dbconnection.execute("END")
-            _dbconnection.commit()
+        # tables added later are created on existing databases too
+        _dbconnection.execute("BEGIN")
+        for query in QUERY_CREATE_TABLE:
+            _dbconnection.execute(query)
+        addDetailColumns(_dbconnection)
+        for query in QUERY_CREATE_INDEX:
+            _dbconnection.execute(query)
+        migrateDatabase(_dbconnection, isNew=table_cnt == 0)
+        _dbconnection.execute("END")
+        _dbconnection.commit()
     return _dbconnection
 
+def addDetailColumns(conn:sqlite3.Connection):
+    """Add the generated columns of LIST_DETAIL_COLUMN missing from the tables."""
+    columns = {}
+    for tbl, col, coltype, path in LIST_DETAIL_COLUMN:
+        if tbl not in columns:
+            columns[tbl] = {row[1] for row in conn.execute(f"PRAGMA table_xinfo({tbl})")}
+        if col not in columns[tbl]:
+            conn.execute(f"ALTER TABLE {tbl} ADD COLUMN {col} {coltype} GENERATED ALWAYS AS (detail->>'{path}') VIRTUAL")
+
+def migrateDatabase(conn:sqlite3.Connection, isNew:bool=False):
+    """Apply the migrations after the PRAGMA user_version of the database."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if not isNew:
+        for i in range(version, SCHEMA_VERSION):
+            logger.info(f"migrate database to version {i + 1}")
+            for query in QUERY_MIGRATION[i]:
+                conn.execute(query)
+    if version != SCHEMA_VERSION:
+        conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+def rebuildDatabase(path_to_logs: List, workers:int=1):
+    """Re-read all journals into a new database file and swap it in atomically."""
+    global _dbconnection
+    path_db = Path(DB_NAME)
+    path_tmp = Path(DB_NAME + REBUILD_SUFFIX)
+    # left over by an interrupted rebuild
+    for p in [path_tmp, Path(f"{path_tmp}-journal")]:
+        p.unlink(missing_ok=True)
+
+    # bring the live database up to date before copying from it
+    if path_db.exists():
+        getConnection()
+    if _dbconnection is not None:
+        closeConnection()
+
+    print("Rebuild database...")
+    conn = sqlite3.connect(path_tmp, detect_types=sqlite3.PARSE_DECLTYPES)
+    for query in QUERY_REBUILD_PRAGMA:
+        conn.execute(query)
+    conn.execute("BEGIN")
+    for query in QUERY_CREATE_TABLE:
+        conn.execute(query)
+    addDetailColumns(conn)
+    migrateDatabase(conn, isNew=True)
+    conn.execute("END")
+    conn.commit()
+    if path_db.exists():
+        copyKeptTables(conn, path_db)
+
+    _dbconnection = conn
+    try:
+        edjournalBulkReadLogs(path_to_logs, workers=workers)
+        with measureTiming("rebuild:index"):
+            conn.execute("BEGIN")
+            for query in QUERY_CREATE_INDEX:
+                conn.execute(query)
+            conn.execute("END")
+            conn.commit()
+            conn.execute("PRAGMA optimize")
+    finally:
+        closeConnection()
+
+    # a stale rollback journal of the old file must not be applied to the new one
+    for suffix in ["-journal", "-wal", "-shm"]:
+        Path(DB_NAME + suffix).unlink(missing_ok=True)
+    os.replace(path_tmp, path_db)
+    print("Rebuild database done")
+
+def copyKeptTables(conn:sqlite3.Connection, path_db:Path):
+    """Copy the tables not derived from journals from the live database."""
+    conn.execute("ATTACH DATABASE ? AS live", (str(path_db),))
+    conn.execute("BEGIN")
+    tables = [row[0] for row in conn.execute("SELECT name FROM main.sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'")]
+    for tbl in tables:
+        if tbl in LIST_JOURNAL_TABLE:
+            continue
+        livecolumns = {row[1] for row in conn.execute(f"PRAGMA live.table_info({tbl})")}
+        columns = [row[1] for row in conn.execute(f"PRAGMA main.table_info({tbl})") if row[1] in livecolumns]
+        if columns:
+            conn.execute(f"INSERT INTO main.{tbl}({', '.join(columns)}) SELECT {', '.join(columns)} FROM live.{tbl}")
+    conn.execute("END")
+    conn.commit()
+    conn.execute("DETACH DATABASE live")
+
 def closeConnection():
     global _dbconnection
+    _readerPool.close()
+    flushWriteBuffer()
     _dbconnection.commit()
+    checkpointWal(force=True)
     _dbconnection.close()
+    _dbconnection = None
+    _writeBuffer.forgetRows()
+    _factionNames.reset()
+    _commodityNames.reset()
+
+def checkpointWal(force:bool=False):
+    """Copy the WAL back into the database once it outgrows WAL_CHECKPOINT_BYTES.
+    Call outside a transaction. A PASSIVE checkpoint never waits for readers;
+    past WAL_TRUNCATE_BYTES, or forced, the WAL is also truncated to zero."""
+    try:
+        size = os.path.getsize(DB_NAME + "-wal")
+    except OSError:
+        return
+    if size < WAL_CHECKPOINT_BYTES and not force:
+        return
+    mode = "TRUNCATE" if force or size >= WAL_TRUNCATE_BYTES else "PASSIVE"
+    with measureTiming("checkpoint"):
+        busy, walpages, donepages = getConnection().execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+    logger.debug(f"checkpoint {mode}: {donepages}/{walpages} pages, busy={busy}")
+
+class ReaderPool:
+    """Thread-safe pool of read-only connections."""
+    def __init__(self, size:int):
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.idle = []
+        # connections opened before close() are dropped when given back
+        self.generation = 0
+
+    def open(self) -> sqlite3.Connection:
+        uri = Path(DB_NAME).resolve().as_uri() + "?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES)
+        for query in QUERY_READER_PRAGMA:
+            conn.execute(query)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        self.slots.acquire()
+        try:
+            with self.lock:
+                generation = self.generation
+                conn = self.idle.pop() if self.idle else None
+            if conn is None:
+                conn = self.open()
+            try:
+                yield conn
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+                with self.lock:
+                    if generation == self.generation:
+                        self.idle.append(conn)
+                        conn = None
+                if conn is not None:
+                    conn.close()
+        finally:
+            self.slots.release()
+
+    def close(self):
+        with self.lock:
+            self.generation += 1
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+_readerPool = ReaderPool(READER_POOL_SIZE)
+
+def readConnection():
+    """Borrow a read-only connection: `with readConnection() as conn: ...`"""
+    return _readerPool.connection()
+
+def closeReadConnections():
+    """Close the pooled read-only connections, for tools that never open the writer."""
+    _readerPool.close()
+
+def queryAll(query:str, params=()) -> List[tuple]:
+    """Run a read-only query on a pooled connection and return all rows."""
+    with readConnection() as conn:
+        return conn.execute(query, params).fetchall()
+
+def queryOne(query:str, params=()) -> tuple:
+    """Run a read-only query on a pooled connection and return the first row."""
+    with readConnection() as conn:
+        return conn.execute(query, params).fetchone()
 
 
 def updateMarketPrice(jsondata:dict):
     KEY_MAPPING = {"Name_Localised":"name", "Name":"name", "BuyPrice":"buyprice", "SellPrice":"sellprice", "StockBracket":"stockbracket", "DemandBracket":"demandbracket", "Stock":"stock", "Demand":"demand"}
     
-    idnametbl = getCommodityBidict()
     pricedata = [{KEY_MAPPING[k]:v for k,v in item.items() if k in KEY_MAPPING} for item in jsondata["Items"] ]
     for item in pricedata:
         item["market_id"] = jsondata["MarketID"]
-        item["commodity_id"] = idnametbl.inverse[item["name"]]
+        item["commodity_id"] = _commodityNames.getId(item["name"])
         item["updated_at"] = jsondata["timestamp"]
 
     conn = getConnection()
     conn.execute("BEGIN")
-    conn.executemany("REPLACE INTO market_price_tbl(market_id, commodity_id, buyprice, sellprice, stockbracket, demandbracket, stock, demand, updated_at) VALUES(:market_id, :commodity_id, :buyprice, :sellprice, :stockbracket, :demandbracket, :stock, :demand, :updated_at)", pricedata)
+    cur = conn.executemany(QUERY_UPSERT_MARKET_PRICE, pricedata)
+    conn.execute(QUERY_UPSERT_MARKET_SEEN, (jsondata["MarketID"], jsondata["timestamp"]))
     conn.execute("END")
     conn.commit()
+    logger.debug(f"market {jsondata['MarketID']}: {cur.rowcount}/{len(pricedata)} prices changed")
     return
 
-def readMarketJson():
-    filepath = f"{PATH_EDLOG_DIR}/Market.json"
+# Only rows with a newer (or no stored) timestamp and a changed price, stock or demand are
+# written; the history triggers then record exactly these changes.
+QUERY_UPSERT_MARKET_PRICE = "INSERT INTO market_price_tbl(market_id, commodity_id, buyprice, sellprice, stockbracket, demandbracket, stock, demand, updated_at) VALUES(:market_id, :commodity_id, :buyprice, :sellprice, :stockbracket, :demandbracket, :stock, :demand, :updated_at) ON CONFLICT(market_id, commodity_id) DO UPDATE SET buyprice=excluded.buyprice, sellprice=excluded.sellprice, stockbracket=excluded.stockbracket, demandbracket=excluded.demandbracket, stock=excluded.stock, demand=excluded.demand, updated_at=excluded.updated_at WHERE (market_price_tbl.updated_at IS NULL OR excluded.updated_at > market_price_tbl.updated_at) AND (buyprice IS NOT excluded.buyprice OR sellprice IS NOT excluded.sellprice OR stock IS NOT excluded.stock OR demand IS NOT excluded.demand)"
+
+# Market.json read again with unchanged prices writes no price row, so the
+# time a market was last read is kept per market. Older files never apply.
+QUERY_UPSERT_MARKET_SEEN = "INSERT INTO market_seen_tbl(market_id, seen_at) VALUES(?, ?) ON CONFLICT(market_id) DO UPDATE SET seen_at=excluded.seen_at WHERE market_seen_tbl.seen_at IS NULL OR excluded.seen_at > market_seen_tbl.seen_at"
+
+def readMarketJson(filepath:str=None):
+    if filepath is None:
+        filepath = f"{PATH_EDLOG_DIR}/Market.json"
     with open(filepath, "r") as f:
         text = f.read()
         jsondata = json.loads(text)
+    jsondata["timestamp"] = parseTimestamp(jsondata.get("timestamp"))
     updateCommodity(jsondata)
     updateMarketPrice(jsondata)
     return
@@ -164,77 +599,847 @@ def updateCommodity(jsondata:dict):
 
     conn = getConnection()
     conn.execute("BEGIN")
-    conn.executemany("INSERT INTO commodity_tbl(name, category, israre) VALUES(:name, :category, :israre) ON CONFLICT(name) DO NOTHING", commodities)
+    for item in commodities:
+        if _commodityNames.find(item["name"]) is None:
+            _commodityNames.getId(item["name"], item)
     conn.execute("END")
     conn.commit()
     return
 
 
-_CommodityBidict = None
-def getCommodityBidict(isUpdate:bool=False) -> bidict:
-    global _CommodityBidict
+# Name interning
+#  In-memory id <-> name maps of faction_tbl and commodity_tbl, loaded once per
+#  connection. Unknown names are added with a single upsert returning the id,
+#  so handlers bind integer ids and never reload the whole table.
+class NameInterner:
+    def __init__(self, table:str):
+        self.table = table
+        self._names = None
+
+    def names(self) -> bidict:
+        """id -> name bidict of the table."""
+        if self._names is None:
+            with measureSql(f"sql:intern:{self.table}"):
+                cur = getConnection().execute(f"SELECT id, name FROM {self.table}")
+                self._names = bidict(cur.fetchall())
+                cur.close()
+        return self._names
+
+    def find(self, name:str) -> int:
+        """Id of a name, None if the table does not have it."""
+        id = self.names().inverse.get(name)
+        if id is None:
+            with measureSql(f"sql:intern:{self.table}"):
+                cur = getConnection().execute(f"SELECT id FROM {self.table} WHERE name=?", (name,))
+                row = cur.fetchone()
+                cur.close()
+            if row is not None:
+                id = row[0]
+                self._names[id] = name
+        return id
+
+    def getId(self, name:str, data:dict=None) -> int:
+        """Id of a name, adding it (with the other columns in data) if it is new."""
+        id = self.names().inverse.get(name)
+        if id is not None:
+            return id
+
+        columns = list(data.keys()) if data else ["name"]
+        params = [data[k] for k in columns] if data else [name]
+        with measureSql(f"sql:intern:{self.table}"):
+            cur = getConnection().execute(f"INSERT INTO {self.table}({', '.join(columns)}) VALUES({', '.join('?' * len(columns))}) ON CONFLICT(name) DO UPDATE SET name=excluded.name RETURNING id", params)
+            id = cur.fetchone()[0]
+            cur.close()
+        self._names[id] = name
+        return id
+
+    def reset(self):
+        self._names = None
+
+_factionNames = NameInterner("faction_tbl")
+_commodityNames = NameInterner("commodity_tbl")
 
-    if _CommodityBidict == None or isUpdate:
-        conn = getConnection()
-        cur = conn.cursor()
-        res_value = cur.execute("SELECT id, name FROM commodity_tbl")
-
-        dictCommodity = {v[0]:v[1] for v in res_value}
-        _CommodityBidict = bidict(dictCommodity)
-
-        res_value.close()
-        cur.close()
-    return _CommodityBidict
-
-def edjournalBulkReadLogs(path_to_logs: List):
+def getCommodityBidict(isUpdate:bool=False) -> bidict:
+    if isUpdate:
+        _commodityNames.reset()
+    return _commodityNames.names()
+
+def getCommodityId(name:str) -> int:
+    return _commodityNames.find(name)
+
+def getPriceTrend(commodity:str, market_id:int=None, since=None) -> List[tuple]:
+    """Recorded prices of a commodity as
+    (market_id, updated_at, buyprice, sellprice, stock, demand), per market in time order."""
+    query = "SELECT market_id, updated_at, buyprice, sellprice, stock, demand FROM market_price_history_tbl WHERE commodity_id=(SELECT id FROM commodity_tbl WHERE name=?)"
+    params = [commodity]
+    if market_id is not None:
+        query += " AND market_id=?"
+        params.append(market_id)
+    if since is not None:
+        query += " AND updated_at>=?"
+        params.append(toEpoch(since))
+    query += " ORDER BY market_id, updated_at"
+    return queryAll(query, params)
+
+def getBestPrices(commodity:str, since=None, limit:int=5) -> dict:
+    """Markets to buy a commodity cheapest and to sell it dearest from the
+    latest prices, as lists of (market_id, market name, system name, price, stock or demand, updated_at).
+    since filters on the time the market was last read, updated_at is the last price change."""
+    query = "SELECT p.market_id, m.name, s.name, p.{price}, p.{amount}, p.updated_at FROM market_price_tbl AS p LEFT JOIN market_tbl AS m ON m.id=p.market_id LEFT JOIN system_tbl AS s ON s.id=m.system_id WHERE p.commodity_id=(SELECT id FROM commodity_tbl WHERE name=:commodity) AND p.{amount}>0 AND p.{price}>0 AND (:since IS NULL OR (SELECT seen_at FROM market_seen_tbl WHERE market_id=p.market_id)>=:since) ORDER BY p.{price} {order} LIMIT :limit"
+    params = {"commodity": commodity, "since": toEpoch(since), "limit": limit}
+    # both lists from the same snapshot
+    with readConnection() as conn:
+        conn.execute("BEGIN")
+        return {
+            "buy": conn.execute(query.format(price="buyprice", amount="stock", order="ASC"), params).fetchall(),
+            "sell": conn.execute(query.format(price="sellprice", amount="demand", order="DESC"), params).fetchall(),
+        }
+
+
+# Time-window queries
+#  Timestamps are Unix epoch seconds. Windows include start and exclude end;
+#  either bound may be None. Bounds are anything toEpoch accepts.
+def getTimeWindow(column:str, start=None, end=None) -> Tuple[str, list]:
+    """WHERE terms and parameters of a time window over column."""
+    terms = []
+    params = []
+    if start is not None:
+        terms.append(f"{column}>=?")
+        params.append(toEpoch(start))
+    if end is not None:
+        terms.append(f"{column}<?")
+        params.append(toEpoch(end))
+    return " AND ".join(terms) or "1", params
+
+def getSystemsVisited(start=None, end=None) -> List[tuple]:
+    """Systems last arrived at within the window as (id, name, lastarrived_at), in time order."""
+    where, params = getTimeWindow("lastarrived_at", start, end)
+    return queryAll(f"SELECT id, name, lastarrived_at FROM system_tbl WHERE lastarrived_at IS NOT NULL AND {where} ORDER BY lastarrived_at", params)
+
+def getBodiesScanned(start=None, end=None) -> List[tuple]:
+    """Bodies last updated within the window as (system_id, body_id, name, type, updated_at), in time order."""
+    where, params = getTimeWindow("updated_at", start, end)
+    return queryAll(f"SELECT system_id, body_id, name, type, updated_at FROM body_tbl WHERE updated_at IS NOT NULL AND {where} ORDER BY updated_at", params)
+
+def getSessions(start=None, end=None) -> List[tuple]:
+    """Play sessions, one per journal, overlapping the window as
+    (path, firstevent_at, lastevent_at, bodies scanned), in time order."""
+    where, params = getTimeWindow("i.lastevent_at", start, None)
+    if end is not None:
+        where += " AND i.firstevent_at<?"
+        params.append(toEpoch(end))
+    return queryAll(f"SELECT i.path, i.firstevent_at, i.lastevent_at, (SELECT COUNT(*) FROM body_tbl AS b WHERE b.updated_at BETWEEN i.firstevent_at AND i.lastevent_at) FROM ingest_state_tbl AS i WHERE i.firstevent_at IS NOT NULL AND {where} ORDER BY i.firstevent_at", params)
+
+def getStatistics(start=None, end=None) -> List[tuple]:
+    """Statistics snapshots within the window as (updated_at, detail as JSON text), in time order."""
+    where, params = getTimeWindow("updated_at", start, end)
+    return queryAll(f"SELECT updated_at, json(detail) FROM statistics_tbl WHERE {where} ORDER BY updated_at", params)
+
+
+def edjournalBulkReadLogs(path_to_logs: List, workers:int=1):
     conn = getConnection()
     conn.execute("BEGIN")
-    for logfile in path_to_logs:
-        edjournalReadLog(logfile)
-    conn.execute("END")
-    conn.commit()
 
-def edjournalReadLog(path_log:str, isWaitforupdate:bool=False):
-    with open(path_log, mode='r') as f:
-        while True:
-            for line in f:
-                try:
-                    data = json.loads(line)
+    pending = []
+    for logfile in path_to_logs:
+        stat = os.stat(logfile)
+        state = getIngestState(logfile)
+        compressed = isCompressedJournal(logfile)
+        plainlog = None
+        if state is None and compressed:
+            # archived after it was imported as a plain journal
+            plainlog = getPlainJournal(logfile)
+            state = getIngestState(plainlog)
+            if state is None:
+                plainlog = None
+        offset = getUnreadOffset(state, stat, compressed)
+        if offset is not None:
+            pending.append((logfile, stat, state, offset, plainlog))
+
+    # flush on row count and file boundaries only, so the sequential and
+    # the parallel path issue exactly the same statements
+    maxdelay, _writeBuffer.maxdelay = _writeBuffer.maxdelay, None
+    try:
+        tasks = [(logfile, offset) for logfile, _, _, offset, _ in pending]
+        if workers > 1:
+            results = parallelReadLogs(tasks, workers)
+        else:
+            results = (edjournalReadLog(logfile, offset) for logfile, offset in tasks)
+
+        for (logfile, stat, state, _, plainlog), (offset, firstevent_at, lastevent_at) in zip(pending, results):
+            flushWriteBuffer()
+            if state is not None:
+                firstevent_at = state["firstevent_at"] or firstevent_at
+                lastevent_at = lastevent_at or state["lastevent_at"]
+            updateIngestState(logfile, stat.st_size, stat.st_mtime_ns, offset, firstevent_at, lastevent_at)
+            if plainlog is not None:
+                # the state moved to the archive
+                deleteIngestState(plainlog)
+            # commit per journal so readers see progress and the WAL stays small
+            with measureTiming("commit"):
+                conn.execute("END")
+                conn.commit()
+            checkpointWal()
+            conn.execute("BEGIN")
+    finally:
+        _writeBuffer.maxdelay = maxdelay
+    with measureTiming("commit"):
+        conn.execute("END")
+        conn.commit()
+
+def getUnreadOffset(state:dict, stat:os.stat_result, compressed:bool=False) -> int:
+    """Return the byte offset to resume a journal from, or None if it is unchanged."""
+    if state is None:
+        return 0
+    if state["size"] == stat.st_size and state["mtime"] == stat.st_mtime_ns:
+        # untouched since last run
+        return None
+    if compressed:
+        # offsets count decompressed bytes, which the file size says nothing about
+        return state["offset"]
+    if state["offset"] <= stat.st_size:
+        # journals are append only: read the unread tail
+        return state["offset"]
+    return 0
+
+def parallelReadLogs(tasks:List[Tuple[str, int]], workers:int):
+    """Parse journals in worker processes and replay their rows in journal order.
+    Only this process writes to the database. Yields edjournalReadLog results."""
+    with ProcessPoolExecutor(max_workers=workers, initializer=initParserProcess, initargs=(_jsonDecoder, _metricsEnabled)) as pool:
+        it = iter(tasks)
+        # bound the parsed files held in memory
+        inflight = deque(pool.submit(parseJournalFile, *task) for task in islice(it, workers * 2))
+        while inflight:
+            plans, rows, offset, firstevent_at, lastevent_at, filterstats, metrics = inflight.popleft().result()
+            _eventFilterStats.update(filterstats)
+            mergeMetrics(metrics)
+            for task in islice(it, 1):
+                inflight.append(pool.submit(parseJournalFile, *task))
+
+            plans = [getUpsertPlan(table, columns) for table, columns in plans]
+            for idx, row in rows:
+                _writeBuffer.addRow(plans[idx], row)
+            yield offset, firstevent_at, lastevent_at
+
+def parseJournalFile(path_log:str, offset:int):
+    """Worker side of parallelReadLogs: run the handlers and collect projected rows."""
+    global _rowSink
+    planindex = {}
+    plans = []
+    rows = []
+
+    def collectRow(plan:UpsertPlan, data:dict):
+        idx = planindex.get(id(plan))
+        if idx is None:
+            idx = planindex[id(plan)] = len(plans)
+            plans.append((plan.table, frozenset(plan.params)))
+        rows.append((idx, plan.project(data)))
+
+    _rowSink = collectRow
+    _eventFilterStats.clear()
+    resetMetrics()
+    try:
+        offset, firstevent_at, lastevent_at = edjournalReadLog(path_log, offset)
+    finally:
+        _rowSink = _writeBuffer.add
+    return plans, rows, offset, firstevent_at, lastevent_at, dict(_eventFilterStats), exportMetrics()
+
+def initParserProcess(decoder:str, metrics:bool):
+    setJsonDecoder(decoder)
+    enableMetrics(metrics)
+
+# Journal files
+#  Journals may be archived as .log.gz or .log.zst. All journals are read in
+#  chunks of JOURNAL_READ_BYTES, compressed ones through a streaming
+#  decompressor, so memory does not grow with the file size. Lines are
+#  pre-filtered in place and only handled events are copied out for
+#  decoding. Offsets count bytes of the decompressed journal.
+JOURNAL_READ_BYTES = 1024 * 1024
+
+def openZstd(path_log:str):
+    if zstandard is None:
+        raise OSError(f"zstandard is not installed, cannot read {path_log}")
+    return zstandard.ZstdDecompressor().stream_reader(open(path_log, mode='rb'), closefd=True)
+
+JOURNAL_DECOMPRESSOR = {".gz": gzip.open, ".zst": openZstd}
+
+def isCompressedJournal(path_log:str) -> bool:
+    return Path(path_log).suffix in JOURNAL_DECOMPRESSOR
+
+def getPlainJournal(path_log:str) -> Path:
+    """Path of the journal without its compression suffix."""
+    path_log = Path(path_log)
+    return path_log.with_suffix("") if isCompressedJournal(path_log) else path_log
+
+def openJournal(path_log:str):
+    """Binary stream of the decompressed journal."""
+    decompressor = JOURNAL_DECOMPRESSOR.get(Path(path_log).suffix)
+    if decompressor is None:
+        return open(path_log, mode='rb', buffering=0)
+    return decompressor(path_log)
+
+def edjournalReadLog(path_log:str, offset:int=0) -> Tuple[int, int, int]:
+    """Read journal events after byte offset.
+    Returns (offset of the unread tail, first event timestamp, last event timestamp)."""
+    with openJournal(path_log) as f:
+        return readJournalEvents(f, offset)
+
+def readJournalEvents(f, offset:int) -> Tuple[int, int, int]:
+    """Dispatch the complete lines of an open journal after byte offset."""
+    firstevent_at = None
+    lastevent_at = None
+    decoded = 0
+    skipped = 0
+    metrics = _metricsEnabled
+    f.seek(offset)
+    partial = b""
+    while chunk := f.read(JOURNAL_READ_BYTES):
+        buf = partial + chunk
+        pos = 0
+        # a line without newline is incomplete, the game is still writing it
+        while (end := buf.find(b"\n", pos) + 1) > 0:
+            header = _JOURNAL_HEADER.match(buf, pos, end)
+            if header is not None and header[2] not in _handledEventRaw:
+                pos = end
+                skipped += 1
+                if metrics:
+                    _metricsCounter[f"unhandled:{header[2].decode()}"] += 1
+                lastevent_at = header[1]
+                if firstevent_at is None:
+                    firstevent_at = lastevent_at
+                continue
+
+            line = buf[pos:end]
+            pos = end
+            decoded += 1
+            try:
+                if metrics:
+                    t0 = time.perf_counter_ns()
+                    data = _jsonLoads(line)
+                    sql0 = _metricsSqlNs
+                    t1 = time.perf_counter_ns()
                     checkEvent(data)
-                except json.JSONDecodeError as e:
-                    logger.error(f"failed to parse json: {e}")
-            if isWaitforupdate:
-                for changes in watch(path_log):
-                    break
+                    t2 = time.perf_counter_ns()
+                    event = data.get("event")
+                    recordTiming(f"parse:{event}", t1 - t0)
+                    recordTiming(f"event:{event}", t2 - t1 - (_metricsSqlNs - sql0))
+                else:
+                    data = _jsonLoads(line)
+                    checkEvent(data)
+                lastevent_at = data.get("timestamp", lastevent_at)
+                if firstevent_at is None:
+                    firstevent_at = lastevent_at
+            except json.JSONDecodeError as e:
+                logger.error(f"failed to parse json: {e}")
+        offset += pos
+        partial = buf[pos:]
+    _eventFilterStats["decoded"] += decoded
+    _eventFilterStats["skipped"] += skipped
+    return offset, parseRawTimestamp(firstevent_at), parseRawTimestamp(lastevent_at)
+
+
+# Live tail
+#  An asyncio pipeline follows the journal directory:
+#    watch  - awatch on the directory, picks the newest journal and schedules
+#             companion files once they have been quiet for TAIL_COMPANION_DEBOUNCE
+#    read   - reads complete lines of the followed journal in chunks
+#    decode - pre-filters and decodes lines into events
+#    write  - runs the handlers (checkEvent) and SQLite on one writer thread and
+#             commits every PIPELINE_COMMIT_EVENTS events or PIPELINE_COMMIT_SECONDS
+#  Stages are connected by bounded queues, so a writer that falls behind
+#  stalls the reader instead of buffering the journal in memory. On stop
+#  every line read so far is written and committed before the ingest state
+#  is saved.
+TAIL_DEBOUNCE_MS = 200
+TAIL_TIMEOUT_MS = 1000
+TAIL_COMPANION_DEBOUNCE = 1.0
+COMPANION_FILES = {"Market.json": readMarketJson}
+PIPELINE_READ_BYTES = 256 * 1024
+PIPELINE_QUEUE_SIZE = 8
+PIPELINE_COMMIT_EVENTS = 1000
+PIPELINE_COMMIT_SECONDS = 0.5
+
+class LineBatch(NamedTuple):
+    path: str
+    lines: List[bytes]
+    offset: int
+
+class EventBatch(NamedTuple):
+    path: str
+    events: List[dict]
+    offset: int
+    firstevent_at: int
+    lastevent_at: int
+
+class IngestPipeline:
+    def __init__(self, path_dir:str, handlers:Tuple[Callable[[dict], None], ...]=None):
+        self.path_dir = Path(path_dir)
+        # called in order for every decoded event
+        self.handlers = handlers or (checkEvent,)
+        self.lines = asyncio.Queue(PIPELINE_QUEUE_SIZE)
+        self.events = asyncio.Queue(PIPELINE_QUEUE_SIZE)
+        self.wake = asyncio.Event()
+        self.stopping = False
+        # newest journal seen by watch, followed by read
+        self.journal = None
+        # written but uncommitted progress per journal: path -> [offset, firstevent_at, lastevent_at]
+        self.progress = {}
+        self.uncommitted = 0
+        self.since = None
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="edlog-writer")
+
+    def db(self, func:Callable, *args):
+        """Run func on the writer thread, the only thread using the database."""
+        return asyncio.get_running_loop().run_in_executor(self.writer, func, *args)
+
+    async def run(self, stop_event=None):
+        edlogs = sorted(self.path_dir.glob("Journal.*.log"))
+        self.journal = edlogs[-1] if edlogs else None
+        stages = [asyncio.create_task(coro) for coro in (self.read(), self.decode(), self.write())]
+        writetask = stages[-1]
+        watcher = asyncio.create_task(self.watch(stop_event))
+        failed = None
+        try:
+            # the stages only end before the watcher when one of them failed
+            done, _ = await asyncio.wait([watcher, *stages], return_when=asyncio.FIRST_COMPLETED)
+            failed = next((task for task in stages if task in done), None)
+            if failed is None:
+                watcher.result()
+        finally:
+            watcher.cancel()
+            if failed is None:
+                # let the stages drain, even when cancelled by Ctrl-C
+                self.stopping = True
+                self.wake.set()
+                await asyncio.shield(asyncio.gather(*stages))
             else:
+                # the others would wait for the failed stage forever
+                for task in stages:
+                    task.cancel()
+                await asyncio.gather(*stages, return_exceptions=True)
+                if failed is not writetask:
+                    # keep what was written before the failure
+                    await self.db(self.commit)
+            self.writer.shutdown()
+        if failed is not None:
+            logger.error("tail stopped: a pipeline stage failed")
+            failed.result()
+
+    async def watch(self, stop_event):
+        duecompanion = {}
+        mtimecompanion = {}
+        self.wake.set()
+        async for changes in awatch(self.path_dir, debounce=TAIL_DEBOUNCE_MS, step=50, rust_timeout=TAIL_TIMEOUT_MS, yield_on_timeout=True, recursive=False, stop_event=stop_event):
+            for change, path in changes:
+                path = Path(path)
+                if change == Change.deleted:
+                    continue
+                if path.name in COMPANION_FILES:
+                    duecompanion[path.name] = time.monotonic() + TAIL_COMPANION_DEBOUNCE
+                elif path.match("Journal.*.log") and (self.journal is None or path.name > self.journal.name):
+                    # the game rolled over to a new journal
+                    self.journal = path
+            self.wake.set()
+
+            now = time.monotonic()
+            for name, due in list(duecompanion.items()):
+                if due > now:
+                    continue
+                del duecompanion[name]
+                filepath = self.path_dir / name
+                try:
+                    mtime = filepath.stat().st_mtime_ns
+                except OSError as e:
+                    logger.error(f"failed to read {name}: {e}")
+                    continue
+                if mtimecompanion.get(name) != mtime:
+                    mtimecompanion[name] = mtime
+                    await self.events.put(filepath)
+
+    async def read(self):
+        loop = asyncio.get_running_loop()
+        path = None
+        f = None
+        offset = 0
+        partial = b""
+        try:
+            while True:
+                await self.wake.wait()
+                self.wake.clear()
+                stopping = self.stopping
+                while True:
+                    if f is not None:
+                        chunk = await loop.run_in_executor(None, f.read, PIPELINE_READ_BYTES)
+                        if chunk:
+                            lines = (partial + chunk).split(b"\n")
+                            partial = lines.pop()
+                            if lines:
+                                offset += sum(len(line) + 1 for line in lines)
+                                await self.lines.put(LineBatch(str(path), lines, offset))
+                            continue
+                    if self.journal is None or self.journal == path:
+                        break
+                    # read the old journal to its end before following the new one
+                    if f is not None:
+                        f.close()
+                    path = self.journal
+                    logger.info(f"follow journal: {path.name}")
+                    f = open(path, mode='rb')
+                    state = await self.db(getIngestState, path)
+                    offset = state["offset"] if state is not None and state["offset"] <= os.fstat(f.fileno()).st_size else 0
+                    f.seek(offset)
+                    partial = b""
+                if stopping:
+                    break
+        finally:
+            if f is not None:
+                f.close()
+            await self.lines.put(None)
+
+    async def decode(self):
+        metrics = _metricsEnabled
+        while (batch := await self.lines.get()) is not None:
+            events = []
+            firstevent_at = None
+            lastevent_at = None
+            skipped = 0
+            for line in batch.lines:
+                header = _JOURNAL_HEADER.match(line)
+                if header is not None and header[2] not in _handledEventRaw:
+                    skipped += 1
+                    if metrics:
+                        _metricsCounter[f"unhandled:{header[2].decode()}"] += 1
+                    timestamp = header[1]
+                else:
+                    try:
+                        t0 = time.perf_counter_ns()
+                        data = _jsonLoads(line)
+                        if metrics:
+                            recordTiming(f"parse:{data.get('event')}", time.perf_counter_ns() - t0)
+                    except json.JSONDecodeError as e:
+                        logger.error(f"failed to parse json: {e}")
+                        continue
+                    timestamp = None
+                    if "timestamp" in data:
+                        timestamp = data["timestamp"] = parseTimestamp(data["timestamp"])
+                    events.append(data)
+                if timestamp is not None:
+                    lastevent_at = timestamp
+                    if firstevent_at is None:
+                        firstevent_at = timestamp
+            _eventFilterStats["decoded"] += len(batch.lines) - skipped
+            _eventFilterStats["skipped"] += skipped
+            await self.events.put(EventBatch(batch.path, events, batch.offset, parseRawTimestamp(firstevent_at), parseRawTimestamp(lastevent_at)))
+        await self.events.put(None)
+
+    async def write(self):
+        while True:
+            timeout = None
+            if self.since is not None:
+                timeout = max(0.0, self.since + PIPELINE_COMMIT_SECONDS - time.monotonic())
+            try:
+                item = await asyncio.wait_for(self.events.get(), timeout)
+            except asyncio.TimeoutError:
+                await self.db(self.commit)
+                continue
+            if item is None:
                 break
+            await self.db(self.writeItem, item)
+        await self.db(self.commit)
+
+    def writeItem(self, item):
+        if isinstance(item, Path):
+            # commit first: companion readers run their own transactions
+            self.commit()
+            try:
+                COMPANION_FILES[item.name](item)
+            except (OSError, json.JSONDecodeError) as e:
+                logger.error(f"failed to read {item.name}: {e}")
+            return
+
+        metrics = _metricsEnabled
+        for data in item.events:
+            sql0 = _metricsSqlNs
+            t0 = time.perf_counter_ns()
+            for handler in self.handlers:
+                try:
+                    handler(data)
+                except Exception as e:
+                    # an event the handlers cannot take must not stop the tail
+                    logger.error(f"failed to handle {data.get('event')} event: {e!r}")
+            if metrics:
+                recordTiming(f"event:{data.get('event')}", time.perf_counter_ns() - t0 - (_metricsSqlNs - sql0))
+        progress = self.progress.setdefault(item.path, [0, None, None])
+        progress[0] = item.offset
+        progress[1] = progress[1] or item.firstevent_at
+        progress[2] = item.lastevent_at or progress[2]
+        self.uncommitted += len(item.events)
+        if self.since is None:
+            self.since = time.monotonic()
+        if self.uncommitted >= PIPELINE_COMMIT_EVENTS:
+            self.commit()
+
+    def commit(self):
+        """Write buffered rows and journal offsets in one transaction."""
+        conn = getConnection()
+        flushWriteBuffer()
+        for path, (offset, firstevent_at, lastevent_at) in self.progress.items():
+            state = getIngestState(path)
+            if state is not None:
+                firstevent_at = state["firstevent_at"] or firstevent_at
+                lastevent_at = lastevent_at or state["lastevent_at"]
+            stat = os.stat(path)
+            if stat.st_size == offset:
+                updateIngestState(path, stat.st_size, stat.st_mtime_ns, offset, firstevent_at, lastevent_at)
+            else:
+                # not read to the end: make the next run resume from offset
+                updateIngestState(path, offset, None, offset, firstevent_at, lastevent_at)
+        self.progress.clear()
+        with measureTiming("commit"):
+            conn.commit()
+        checkpointWal()
+        self.uncommitted = 0
+        self.since = None
+
+def edjournalTail(path_dir:str, stop_event=None):
+    """Follow the newest journal in path_dir, switching to new journals as the
+    game creates them, and re-read companion files such as Market.json.
+    Runs until stop_event is set or the process is interrupted."""
+    asyncio.run(IngestPipeline(path_dir).run(stop_event))
+
+
+def getIngestState(path_log:str) -> dict:
+    conn = getConnection()
+    cur = conn.cursor()
+    cur.execute("SELECT size, mtime, offset, firstevent_at, lastevent_at FROM ingest_state_tbl WHERE path=?", (str(path_log),))
+    row = cur.fetchone()
+    cur.close()
+    if row is None:
+        return None
+    return dict(zip(("size", "mtime", "offset", "firstevent_at", "lastevent_at"), row))
+
+def updateIngestState(path_log:str, size:int, mtime:int, offset:int, firstevent_at:int, lastevent_at:int):
+    conn = getConnection()
+    conn.execute("REPLACE INTO ingest_state_tbl(path, size, mtime, offset, firstevent_at, lastevent_at) VALUES(?, ?, ?, ?, ?, ?)", (str(path_log), size, mtime, offset, firstevent_at, lastevent_at))
+
+def deleteIngestState(path_log:str):
+    conn = getConnection()
+    conn.execute("DELETE FROM ingest_state_tbl WHERE path=?", (str(path_log),))
+
+
+# Instrumentation
+#  Counters and timing histograms per event type, handler and table:
+#   parse:<event>    JSON decoding
+#   event:<event>    checkEvent, i.e. projection of the event into rows
+#   handler:<name>   a single update* handler
+#   sql:<table>      executemany of buffered rows
+#   sql:intern:<table>  name -> id lookups and inserts of faction and commodity names
+#   commit           transaction commit
+#   unhandled:<event>, rows:<table>  counters
+#  SQL run within an event or handler, by the name interners or a flush of
+#  the full write buffer, is only reported under sql:, so that parse, event,
+#  sql and commit add up.
+#  Disabled by default. Handlers are only wrapped while enabled and the other
+#  call sites test _metricsEnabled once.
+LIST_TIMED_HANDLER = ["updateSystem", "updateBody", "updateMarket", "updateFaction", "updateSystemFaction", "updateStatistics", "updateCommodity", "updateMarketPrice"]
+
+class TimingHistogram:
+    """Durations in power-of-two nanosecond buckets."""
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets = Counter()
+
+    def add(self, ns:int):
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+        self.buckets[ns.bit_length()] += 1
+
+    def merge(self, other:"TimingHistogram"):
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.buckets.update(other.buckets)
+
+    def percentile(self, q:float) -> int:
+        """Upper bound of the bucket holding the q-quantile."""
+        rank = q * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(1 << bucket, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {"count": self.count, "total_ms": self.total / 1e6, "mean_us": self.total / self.count / 1e3 if self.count else 0.0, "p50_us": self.percentile(0.5) / 1e3, "p90_us": self.percentile(0.9) / 1e3, "p99_us": self.percentile(0.99) / 1e3, "max_us": self.max / 1e3}
+
+_metricsEnabled = False
+_metricsCounter = Counter()
+_metricsTiming: Dict[str, TimingHistogram] = {}
+# total of the sql: timings, subtracted from the event and handler timings
+_metricsSqlNs = 0
+
+def enableMetrics(enabled:bool=True):
+    global _metricsEnabled
+    if enabled == _metricsEnabled:
+        return
+    _metricsEnabled = enabled
+    for name in LIST_TIMED_HANDLER:
+        func = globals()[name]
+        globals()[name] = timedHandler(name, func) if enabled else func.__wrapped__
+    bindEventHandlers()
+
+def timedHandler(name:str, func:Callable) -> Callable:
+    key = f"handler:{name}"
+    @wraps(func)
+    def wrapper(jsondata):
+        sql0 = _metricsSqlNs
+        t0 = time.perf_counter_ns()
+        try:
+            return func(jsondata)
+        finally:
+            recordTiming(key, time.perf_counter_ns() - t0 - (_metricsSqlNs - sql0))
+    return wrapper
+
+def recordTiming(name:str, ns:int):
+    hist = _metricsTiming.get(name)
+    if hist is None:
+        hist = _metricsTiming[name] = TimingHistogram()
+    hist.add(ns)
+
+def recordSqlTiming(name:str, ns:int):
+    global _metricsSqlNs
+    _metricsSqlNs += ns
+    recordTiming(name, ns)
+
+@contextmanager
+def measureSql(name:str):
+    if not _metricsEnabled:
+        yield
+        return
+    t0 = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        recordSqlTiming(name, time.perf_counter_ns() - t0)
+
+@contextmanager
+def measureTiming(name:str):
+    if not _metricsEnabled:
+        yield
+        return
+    t0 = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        recordTiming(name, time.perf_counter_ns() - t0)
+
+def resetMetrics():
+    _metricsCounter.clear()
+    _metricsTiming.clear()
+
+def exportMetrics() -> Tuple[dict, dict]:
+    return dict(_metricsCounter), dict(_metricsTiming)
+
+def mergeMetrics(metrics:Tuple[dict, dict]):
+    counters, timings = metrics
+    _metricsCounter.update(counters)
+    for name, hist in timings.items():
+        _metricsTiming.setdefault(name, TimingHistogram()).merge(hist)
+
+def getMetrics() -> dict:
+    """Snapshot of the counters and timing summaries, e.g. while tailing."""
+    return {
+        "counter": dict(_metricsCounter),
+        "timing": {name: hist.summary() for name, hist in list(_metricsTiming.items())},
+        "upsertplan": getUpsertPlanStats(),
+        "eventfilter": getEventFilterStats(),
+    }
+
+def formatMetrics() -> str:
+    metrics = getMetrics()
+    lines = [f"{'timing':40} {'count':>9} {'total ms':>10} {'mean us':>9} {'p50 us':>9} {'p90 us':>9} {'p99 us':>9} {'max us':>10}"]
+    for name, t in sorted(metrics["timing"].items()):
+        lines.append(f"{name:40} {t['count']:9} {t['total_ms']:10.1f} {t['mean_us']:9.1f} {t['p50_us']:9.1f} {t['p90_us']:9.1f} {t['p99_us']:9.1f} {t['max_us']:10.1f}")
+    lines.append(f"{'counter':40} {'count':>9}")
+    for name, count in sorted(metrics["counter"].items()):
+        lines.append(f"{name:40} {count:9}")
+    lines.append(f"upsert plan cache: {metrics['upsertplan']}")
+    lines.append(f"event filter: {metrics['eventfilter']}")
+    return "\n".join(lines)
+
+
+# Event pre-filter
+#  Journal lines start with timestamp and event, e.g.
+#  { "timestamp":"2024-01-01T00:00:00Z", "event":"Music", ... }
+#  Lines of events without handlers in DICT_EVENT_HANDLER are skipped
+#  without decoding them.
+#  Lines not in this form are always decoded.
+
+# Handlers called in order by checkEvent for each event. Looked up by name
+# so that enableMetrics can wrap them.
+DICT_EVENT_HANDLER = {
+    "ApproachSettlement": ["updateMarket"],
+    "Docked": ["updateMarket"],
+    "Location": ["updateMarket"],
+    "Scan": ["eventScan"],
+    "StartJump": ["updateSystem"],
+    "Statistics": ["updateStatistics"],
+    "SupercruiseExit": ["updateBody"],
+    "FSDJump": ["updateSystem", "updateBody", "updateFaction", "updateSystemFaction"],
+    }
+LIST_HANDLED_EVENT = list(DICT_EVENT_HANDLER)
+_JOURNAL_HEADER = re.compile(rb'\{\s*"timestamp"\s*:\s*"([^"]*)"\s*,\s*"event"\s*:\s*"([^"]*)"')
+_handledEventRaw = frozenset(event.encode() for event in LIST_HANDLED_EVENT)
+_eventFilterStats = Counter()
+
+def getEventFilterStats() -> dict:
+    return {"decoded": _eventFilterStats["decoded"], "skipped": _eventFilterStats["skipped"]}
+
+# JSON decoder of journal lines: "json", or "orjson" if it is installed
+_jsonDecoder = "json"
+_jsonLoads = json.loads
+def setJsonDecoder(name:str="auto") -> str:
+    global _jsonDecoder, _jsonLoads
+    if name == "auto":
+        name = "json" if orjson is None else "orjson"
+    match name:
+        case "json":
+            _jsonLoads = json.loads
+        case "orjson":
+            if orjson is None:
+                raise ValueError("orjson is not installed")
+            _jsonLoads = orjson.loads
+        case _:
+            raise ValueError(f"unknown JSON decoder: {name}")
+    _jsonDecoder = name
+    return name
 
 
+# DICT_EVENT_HANDLER resolved to functions, rebound when handlers are wrapped
+_eventHandlers = None
+def bindEventHandlers():
+    global _eventHandlers
+    _eventHandlers = {event: tuple(globals()[name] for name in names) for event, names in DICT_EVENT_HANDLER.items()}
+
 def checkEvent(jsondata):
     event = jsondata["event"]
-    match event:
-        case "ApproachSettlement":
-            updateMarket(jsondata)
-        case "Docked":
-            updateMarket(jsondata)
-        case "Location":
-            updateMarket(jsondata)
-        case "Scan":
-            eventScan(jsondata)
-        case "StartJump":
-            updateSystem(jsondata)
-        case "Statistics":
-            updateStatistics(jsondata)
-        case "SupercruiseExit":
-            updateBody(jsondata)
-        case "FSDJump":
-            updateSystem(jsondata)
-            updateBody(jsondata)
-            updateFaction(jsondata)
-            updateSystemFaction(jsondata)
-        case _:
-            # logger.info(f"no handling event: {event}")
-            pass
+    if "timestamp" in jsondata:
+        jsondata["timestamp"] = parseTimestamp(jsondata["timestamp"])
+    if _eventHandlers is None:
+        bindEventHandlers()
+    handlers = _eventHandlers.get(event)
+    if handlers is None:
+        # logger.info(f"no handling event: {event}")
+        if _metricsEnabled:
+            _metricsCounter[f"unhandled:{event}"] += 1
+        return
+    for handler in handlers:
+        handler(jsondata)
 
 
 def eventScan(jsondata:dict):
@@ -252,11 +1457,241 @@ def eventScan(jsondata:dict):
             pass
 
 
+# Upsert plans
+#  conflict: conflict target of ON CONFLICT
+#  jsonpatch: JSONB columns merged with jsonb_patch on update
+#  jsonreplace: JSONB columns replaced on update
+#  factionref: columns given as a faction name and bound as its faction_tbl.id
+# With updated_at, an update newer than the stored row always applies, one
+# as old applies only if it changes a column, and an older one never does,
+# so replayed events leave the pages untouched and updated_at is the newest
+# sighting. Without updated_at, an update applies if it changes a column.
+UPSERT_TABLE = {
+    "system_tbl": {"conflict": ("id",), "jsonpatch": ("detail",), "jsonreplace": (), "factionref": ("systemfaction_id",)},
+    "body_tbl": {"conflict": ("system_id", "body_id"), "jsonpatch": ("detail",), "jsonreplace": (), "factionref": ()},
+    "market_tbl": {"conflict": ("id",), "jsonpatch": ("detail",), "jsonreplace": (), "factionref": ("stationfaction_id",)},
+    "faction_tbl": {"conflict": ("name",), "jsonpatch": (), "jsonreplace": (), "factionref": ()},
+    "system_faction_tbl": {"conflict": ("system_id", "faction_id"), "jsonpatch": (), "jsonreplace": ("state",), "factionref": ("faction_id",)},
+    "statistics_tbl": {"conflict": ("updated_at",), "jsonpatch": ("detail",), "jsonreplace": (), "factionref": ()},
+}
+
+class UpsertPlan(NamedTuple):
+    table: str
+    sql: str
+    params: Tuple[str, ...]
+    project: Callable[[dict], tuple]
+    conflictkey: Callable[[tuple], tuple]
+    factionref: Tuple[int, ...]
+    updatedat: int
+
+_upsertPlanCache: Dict[Tuple[str, frozenset], UpsertPlan] = {}
+_upsertPlanStats = Counter()
+def getUpsertPlan(table:str, columns) -> UpsertPlan:
+    """Return the cached upsert plan for the set of columns present in a row."""
+    key = (table, frozenset(columns))
+    plan = _upsertPlanCache.get(key)
+    if plan is not None:
+        _upsertPlanStats["hit"] += 1
+        return plan
+
+    _upsertPlanStats["miss"] += 1
+    plan = buildUpsertPlan(table, key[1])
+    _upsertPlanCache[key] = plan
+    logger.debug(plan.sql)
+    return plan
+
+def buildUpsertPlan(table:str, columns:frozenset) -> UpsertPlan:
+    spec = UPSERT_TABLE[table]
+    conflict = spec["conflict"]
+    listColumn = list(conflict) + sorted(columns.difference(conflict))
+
+    values = []
+    params = []
+    updates = []
+    changes = []
+    for col in listColumn:
+        if col in spec["jsonpatch"]:
+            values.append("jsonb(?)")
+            params.append(col)
+        elif col in spec["jsonreplace"]:
+            values.append("jsonb(?)")
+            params.append(col)
+        else:
+            values.append("?")
+            params.append(col)
+
+        if col in conflict:
+            pass
+        elif col in spec["jsonpatch"]:
+            updates.append(f"{col}=jsonb_patch({col}, excluded.{col})")
+            changes.append(f"jsonb_patch({table}.{col}, excluded.{col}) IS NOT {table}.{col}")
+        else:
+            updates.append(f"{col}=excluded.{col}")
+            if col != "updated_at":
+                changes.append(f"{table}.{col} IS NOT excluded.{col}")
+
+    query = f"INSERT INTO {table}({', '.join(listColumn)}) VALUES({', '.join(values)})"
+
+    guarded = "updated_at" in columns and "updated_at" not in conflict
+    if guarded:
+        changed = f" OR (excluded.updated_at={table}.updated_at AND ({' OR '.join(changes)}))" if changes else ""
+        query += f" ON CONFLICT({', '.join(conflict)}) DO UPDATE SET {', '.join(updates)} WHERE {table}.updated_at IS NULL OR excluded.updated_at>{table}.updated_at{changed};"
+    elif changes:
+        query += f" ON CONFLICT({', '.join(conflict)}) DO UPDATE SET {', '.join(updates)} WHERE {' OR '.join(changes)};"
+    else:
+        query += f" ON CONFLICT({', '.join(conflict)}) DO NOTHING;"
+
+    if len(params) == 1:
+        param = params[0]
+        project = lambda data: (data[param],)
+    else:
+        project = itemgetter(*params)
+    conflictkey = itemgetter(*[params.index(col) for col in conflict])
+    factionref = tuple(params.index(col) for col in spec["factionref"] if col in columns)
+    # position of updated_at if the update is guarded by it
+    updatedat = params.index("updated_at") if guarded else None
+    return UpsertPlan(table, query, tuple(params), project, conflictkey, factionref, updatedat)
+
+def getUpsertPlanStats() -> dict:
+    total = _upsertPlanStats["hit"] + _upsertPlanStats["miss"]
+    hitrate = _upsertPlanStats["hit"] / total if total > 0 else 0.0
+    return {"hit": _upsertPlanStats["hit"], "miss": _upsertPlanStats["miss"], "hitrate": hitrate, "plans": len(_upsertPlanCache)}
+
+def executeUpsert(table:str, data:dict):
+    _rowSink(getUpsertPlan(table, data.keys()), data)
+
+
+# Write-behind buffer
+#  Rows are grouped per plan into segments and flushed with executemany.
+#  A row joins the latest segment of its plan unless a later segment of the
+#  same table holds the same conflict key, so updates of one row keep their
+#  order while updates of different rows are grouped freely.
+#  Faction names are interned when a row is added, so no table depends on
+#  another being flushed first.
+#  The buffer remembers the newest updated_at and the last row added per
+#  conflict key. Rows older than that, and repeats of the last row with the
+#  same updated_at, are dropped before they reach SQLite, like the upsert
+#  guards would drop them. Newer rows always pass.
+WRITEBUFFER_MAXROWS = 5000
+WRITEBUFFER_MAXDELAY = 1.0
+WRITEBUFFER_MAXKEYS = 200000
+
+class WriteSegment(NamedTuple):
+    plan: UpsertPlan
+    rows: list
+    keys: set
+
+class WriteBuffer:
+    def __init__(self, maxrows:int=WRITEBUFFER_MAXROWS, maxdelay:float=WRITEBUFFER_MAXDELAY):
+        self.maxrows = maxrows
+        self.maxdelay = maxdelay
+        self._segments: Dict[str, List[WriteSegment]] = {}
+        self._pending = 0
+        self._since = None
+        # (table, conflict key) -> (plan, hash of row, newest updated_at)
+        self._lastrow: Dict[tuple, tuple] = {}
+        self.stats = Counter()
+
+    def add(self, plan:UpsertPlan, data:dict):
+        self.addRow(plan, plan.project(data))
+
+    def addRow(self, plan:UpsertPlan, row:tuple):
+        if plan.factionref:
+            row = list(row)
+            for i in plan.factionref:
+                row[i] = _factionNames.getId(row[i])
+            row = tuple(row)
+        key = plan.conflictkey(row)
+        if self.isSuppressed(plan, key, row):
+            return
+        segments = self._segments.setdefault(plan.table, [])
+        for seg in reversed(segments):
+            if seg.plan is plan:
+                seg.rows.append(row)
+                seg.keys.add(key)
+                break
+            if key in seg.keys:
+                segments.append(WriteSegment(plan, [row], {key}))
+                break
+        else:
+            segments.append(WriteSegment(plan, [row], {key}))
+
+        self._pending += 1
+        if self._since is None:
+            self._since = time.monotonic()
+        if self._pending >= self.maxrows or (self.maxdelay is not None and time.monotonic() - self._since >= self.maxdelay):
+            self.flush()
+
+    def isSuppressed(self, plan:UpsertPlan, key:tuple, row:tuple) -> bool:
+        """Check a row against the last row of its conflict key and remember it."""
+        lastkey = (plan.table, key)
+        updated_at = row[plan.updatedat] if plan.updatedat is not None else None
+        rowhash = hash(row)
+        last = self._lastrow.pop(lastkey, None)
+        if last is not None:
+            lastplan, lasthash, lastupdated_at = last
+            if updated_at is not None and lastupdated_at is not None and updated_at < lastupdated_at:
+                self._lastrow[lastkey] = last
+                self.stats["stale"] += 1
+                return True
+            # a newer sighting must still reach the database to advance updated_at
+            if lastplan is plan and lasthash == rowhash and updated_at == lastupdated_at:
+                self._lastrow[lastkey] = last
+                self.stats["duplicate"] += 1
+                return True
+        if updated_at is None and last is not None:
+            updated_at = last[2]
+        self._lastrow[lastkey] = (plan, rowhash, updated_at)
+        if len(self._lastrow) > WRITEBUFFER_MAXKEYS:
+            for k in list(islice(self._lastrow, WRITEBUFFER_MAXKEYS // 4)):
+                del self._lastrow[k]
+        return False
+
+    def forgetRows(self):
+        """Drop the remembered rows, e.g. when the database changes."""
+        self._lastrow.clear()
+
+    def flush(self):
+        if self._pending == 0:
+            return
+        conn = getConnection()
+        for tbl in self._segments:
+            for seg in self._segments[tbl]:
+                if _metricsEnabled:
+                    t0 = time.perf_counter_ns()
+                    cur = conn.executemany(seg.plan.sql, seg.rows)
+                    recordSqlTiming(f"sql:{tbl}", time.perf_counter_ns() - t0)
+                    _metricsCounter[f"rows:{tbl}"] += len(seg.rows)
+                else:
+                    cur = conn.executemany(seg.plan.sql, seg.rows)
+                self.stats["rows"] += len(seg.rows)
+                self.stats["written"] += cur.rowcount
+        self._segments.clear()
+        self._pending = 0
+        self._since = None
+
+    def __len__(self):
+        return self._pending
+
+_writeBuffer = WriteBuffer()
+def flushWriteBuffer():
+    _writeBuffer.flush()
+
+def getWriteStats() -> dict:
+    """Rows handed to the write buffer and how many of them changed nothing."""
+    stats = _writeBuffer.stats
+    suppressed = stats["stale"] + stats["duplicate"] + stats["rows"] - stats["written"]
+    return {"rows": stats["rows"] + stats["stale"] + stats["duplicate"], "written": stats["written"], "stale": stats["stale"], "duplicate": stats["duplicate"], "suppressed": suppressed}
+
+# destination of rows built by the handlers, replaced in parser processes
+_rowSink = _writeBuffer.add
+
+
 def updateSystem(jsondata:dict):
     KEY_SYSTEM = {"SystemAddress":"id", "StarSystem":"name", "StarPos":"pos", "StarClass":"startype", "SystemAllegiance":"allegiance", "SystemEconomy_Localised":"economy", "SystemSecondEconomy_Localised":"economysecond", "SystemGovernment_Localised":"government", "SystemSecurity_Localised":"security", "Population":"population", "SystemFaction":"systemfaction_id", "timestamp":"updated_at"}
     LIST_SYSTEM_DETAIL = ["ControllingPower", "Powers", "PowerplayState", "PowerplayStateControlProgress", "PowerplayStateReinforcement", "PowerplayStateUndermining","Factions", "SystemFaction"]
 
-    data = {k: v for k, v in jsondata.items() if k in KEY_SYSTEM and v != ""}
+    data = {KEY_SYSTEM[k]: v for k, v in jsondata.items() if k in KEY_SYSTEM and v != ""}
     detail = {k: v for k, v in jsondata.items() if k in LIST_SYSTEM_DETAIL and v != ""}
 
     if len(detail) > 0:
@@ -264,93 +1699,40 @@ def updateSystem(jsondata:dict):
 
     if jsondata["event"] == "FSDJump":
         data["lastarrived_at"] = jsondata["timestamp"]
-        KEY_SYSTEM.update(lastarrived_at="lastarrived_at")
-
-    if "StarPos" in data:
-        x,y,z = data.pop("StarPos")
-        data["posx"] = x
-        data["posy"] = y
-        data["posz"] = z
-        KEY_SYSTEM.update(posx="posx",posy="posy",posz="posz")
-
-    if "SystemFaction" in data:
-        data["SystemFaction"] = data["SystemFaction"]["Name"]
-
-    if "SystemAddress" in data and len(data) >= 2:
-        tmp1 = "INSERT INTO system_tbl(id,"
-        tmp2 = " SELECT :SystemAddress,"
-        tmpextbl = ""
-        tmp3 = " ON CONFLICT(id) DO UPDATE SET"
-        for k,v in data.items():
-            match k:
-                case "SystemAddress":
-                    pass
-                case "SystemFaction":
-                    tmp1 += f" {KEY_SYSTEM[k]},"
-                    tmp2 += f" faction_tbl.id,"
-                    tmpextbl = f" FROM faction_tbl WHERE faction_tbl.name=:{k} "
-                    tmp3 += f" {KEY_SYSTEM[k]}=excluded.{KEY_SYSTEM[k]},"
-                case "detail":
-                    tmp1 += f" detail,"
-                    tmp2 += f" jsonb(:detail),"
-                    tmp3 += f" detail=jsonb_patch(detail, excluded.detail),"
-                case _:
-                    tmp1 += f" {KEY_SYSTEM[k]},"
-                    tmp2 += f" :{k},"
-                    tmp3 += f" {KEY_SYSTEM[k]}=excluded.{KEY_SYSTEM[k]},"
-        query = re.sub(',$',') ',tmp1) + re.sub(',$',' ',tmp2) + tmpextbl + re.sub(',$',';',tmp3)
-        logger.debug(query)
-        db = getConnection()
-        cur = db.cursor()
-        cur.execute(query, data)
-        cur.close()
+
+    if "pos" in data:
+        data["posx"], data["posy"], data["posz"] = data.pop("pos")
+
+    if "systemfaction_id" in data:
+        data["systemfaction_id"] = data["systemfaction_id"]["Name"]
+
+    if "id" in data and len(data) >= 2:
+        executeUpsert("system_tbl", data)
 
 
 def updateBody(jsondata:dict):
     KEY_BODY = {"SystemAddress":"system_id", "BodyID":"body_id", "BodyName":"name", "Body":"name", "BodyType":"type","WasDiscovered":"wasdiscovered", "WasMapped":"wasmapped", "timestamp":"updated_at"}
     LIST_BODY_DETAIL = ['Parents', 'DistanceFromArrivalLS', 'TidalLock', 'TerraformState', 'PlanetClass', 'Atmosphere', 'AtmosphereType', 'Volcanism', 'MassEM', 'Radius', 'SurfaceGravity', 'SurfaceTemperature', 'SurfacePressure', 'Landable', 'Materials', 'Composition', 'SemiMajorAxis', 'Eccentricity', 'OrbitalInclination', 'Periapsis', 'OrbitalPeriod', 'AscendingNode', 'MeanAnomaly', 'RotationPeriod', 'AxialTilt']
 
-    data = {k: v for k,v in jsondata.items() if k in KEY_BODY and v != ""}
+    data = {KEY_BODY[k]: v for k,v in jsondata.items() if k in KEY_BODY and v != ""}
     detail = {k: v for k,v in jsondata.items() if k in LIST_BODY_DETAIL and v != ""}
 
     if len(detail) > 0:
         data["detail"] = json.dumps(detail, ensure_ascii=False)
 
-    if data.keys() >= {"SystemAddress", "BodyID"}:
-        tmp1 = "INSERT INTO body_tbl(system_id, body_id,"
-        tmp2 = " VALUES(:SystemAddress, :BodyID,"
-        tmp3 = " ON CONFLICT(system_id, body_id) DO UPDATE SET"
-        for k,v in data.items():
-            match k:
-                case "SystemAddress":
-                    pass
-                case "BodyID":
-                    pass
-                case "detail":
-                    tmp1 += f" detail,"
-                    tmp2 += f" jsonb(:detail),"
-                    tmp3 += f" detail=jsonb_patch(detail, excluded.detail),"
-                case _:
-                    tmp1 += f" {KEY_BODY[k]},"
-                    tmp2 += f" :{k},"
-                    tmp3 += f" {KEY_BODY[k]}=excluded.{KEY_BODY[k]},"
-        query = re.sub(',$',') ',tmp1) + re.sub(',$',') ',tmp2) + re.sub(',$',';',tmp3)
-        # logger.debug(query)
-        db = getConnection()
-        cur = db.cursor()
-        cur.execute(query,data)
-        cur.close()
+    if data.keys() >= {"system_id", "body_id"}:
+        executeUpsert("body_tbl", data)
 
 
 def updateMarket(jsondata:dict):
-    KEY_MARKET = {"MarketID":"id", "StationName":"name", "Name":"name", "SystemAddress":"system_id", "BodyID":"body_id", "StationType":"type", "StationGovernment_Localised":"goverment", "StationEconomy_Localised":"economy", "StationFaction":"stationfaction_id", "DistFromStarLS":"distfromstarls", "pads":"pads", "padm":"padm", "padl":"padl", "timestamp":"updated_at"}
+    KEY_MARKET = {"MarketID":"id", "StationName":"name", "Name":"name", "SystemAddress":"system_id", "BodyID":"body_id", "StationType":"type", "StationGovernment_Localised":"goverment", "StationEconomy_Localised":"economy", "StationFaction":"stationfaction_id", "DistFromStarLS":"distfromstarls", "timestamp":"updated_at"}
     LIST_MARKET_DETAIL = ['StationServices']
-    
-    data = {k:v for k,v in jsondata.items() if k in KEY_MARKET and v != ""}
+
+    data = {KEY_MARKET[k]:v for k,v in jsondata.items() if k in KEY_MARKET and v != ""}
     detail = {k:v for k,v in jsondata.items() if k in LIST_MARKET_DETAIL and v != ""}
 
-    if "StationFaction" in data:
-        data["StationFaction"] = data["StationFaction"]["Name"]
+    if "stationfaction_id" in data:
+        data["stationfaction_id"] = data["stationfaction_id"]["Name"]
 
     KEY_PADS = {"Small":"pads", "Medium":"padm", "Large":"padl"}
     if "LandingPads" in jsondata:
@@ -359,101 +1741,34 @@ def updateMarket(jsondata:dict):
     if len(detail) > 0:
         data['detail'] = json.dumps(detail, ensure_ascii=False)
 
-    if "MarketID" in data:
-        tmp1 = "INSERT INTO market_tbl(id,"
-        tmp2 = " SELECT :MarketID,"
-        tmpextbl = ""
-        tmp3 = " ON CONFLICT(id) DO UPDATE SET"
-        for k,v in data.items():
-            match k:
-                case "MarketID":
-                    pass
-                case "StationFaction":
-                    tmp1 += f" {KEY_MARKET[k]},"
-                    tmp2 += f" faction_tbl.id,"
-                    tmpextbl = f" FROM faction_tbl WHERE faction_tbl.name=:{k} "
-                    tmp3 += f" {KEY_MARKET[k]}=excluded.{KEY_MARKET[k]},"
-                case "detail":
-                    tmp1 += f" detail,"
-                    tmp2 += f" jsonb(:detail),"
-                    tmp3 += f" detail=jsonb_patch(detail, excluded.detail),"
-                case _:
-                    tmp1 += f" {KEY_MARKET[k]},"
-                    tmp2 += f" :{k},"
-                    tmp3 += f" {KEY_MARKET[k]}=excluded.{KEY_MARKET[k]},"
-        query = re.sub(',$',') ',tmp1) + re.sub(',$',' ',tmp2) + tmpextbl + re.sub(',$',';',tmp3)
-        logger.debug(query)
-        db = getConnection()
-        cur = db.cursor()
-        cur.execute(query,data)
-        cur.close()
+    if "id" in data:
+        executeUpsert("market_tbl", data)
 
 
 def updateFaction(jsondata:dict):
     KEY_FACTION = {"Name":"name", "Government":"government", "Allegiance":"allegiance", "MyReputation":"myreputation"}
 
     if "Factions" in jsondata:
-        factions = jsondata["Factions"]
-        data = [{KEY_FACTION[k]:v for k,v in fac.items() if k in KEY_FACTION} for fac in factions]
-        for d in data:
-            d["updated_at"] = jsondata["timestamp"]
-
-        if len(data) > 0:
-            tmp1 = "INSERT INTO faction_tbl(name,"
-            tmp2 = " VALUES(:name,"
-            tmp3 = " ON CONFLICT(name) DO UPDATE SET"
-            for k,v in data[0].items():
-                match k:
-                    case "name":
-                        pass
-                    case _:
-                        tmp1 += f" {k},"
-                        tmp2 += f" :{k},"
-                        tmp3 += f" {k}=excluded.{k},"
-            query = re.sub(',$',') ',tmp1) + re.sub(',$',') ',tmp2) + re.sub(',$',';',tmp3)
-            conn = getConnection()
-            conn.executemany(query, data)
+        for fac in jsondata["Factions"]:
+            data = {KEY_FACTION[k]:v for k,v in fac.items() if k in KEY_FACTION}
+            data["updated_at"] = jsondata["timestamp"]
+            executeUpsert("faction_tbl", data)
 
 
 def updateSystemFaction(jsondata:dict):
-    KEY_SYSTEM_FACTION = {"SystemAddress":"system_id","Name":"name", "FactionState":"state", "Influence":"influence", "Happiness":"happiness", "timestamp":"updated_at"}
+    KEY_SYSTEM_FACTION = {"Name":"faction_id", "Influence":"influence", "Happiness":"happiness"}
     LIST_STATE = ["ActiveStates", "PendingStates"]
 
     if "Factions" in jsondata:
         factions = mergeLocalizedArray(jsondata["Factions"])
         for fac in factions:
+            data = {KEY_SYSTEM_FACTION[k]:v for k,v in fac.items() if k in KEY_SYSTEM_FACTION}
             # merge ActiveState/PendingState to state field
             state = {k:v for k, v in fac.items() if k in LIST_STATE}
-            fac["FactionState"] = json.dumps(state, ensure_ascii=False)
-            fac["timestamp"] = jsondata["timestamp"]
-
-        data = [{k:v for k,v in fac.items() if k in KEY_SYSTEM_FACTION} for fac in factions]
-        
-        for v in data:
-            v["SystemAddress"] = jsondata["SystemAddress"]
-
-        if len(data) > 0:
-            tmp1 = "INSERT INTO system_faction_tbl(system_id, faction_id,"
-            tmp2 = " SELECT :SystemAddress, faction_tbl.id,"
-            tmp3 = " FROM faction_tbl WHERE name=:Name "
-            tmp4 = " ON CONFLICT(system_id, faction_id) DO UPDATE SET"
-            for k,v in data[0].items():
-                match k:
-                    case "SystemAddress":
-                        pass
-                    case "Name":
-                        pass
-                    case "FactionState":
-                        tmp1 += f" state,"
-                        tmp2 += f" jsonb(:FactionState),"
-                        tmp4 += f" state=excluded.state,"
-                    case _:
-                        tmp1 += f" {KEY_SYSTEM_FACTION[k]},"
-                        tmp2 += f" :{k},"
-                        tmp4 += f" {KEY_SYSTEM_FACTION[k]}=excluded.{KEY_SYSTEM_FACTION[k]},"
-            query = re.sub(',$',') ',tmp1) + re.sub(',$',' ',tmp2) + tmp3 + re.sub(',$',';',tmp4)
-            conn = getConnection()
-            conn.executemany(query, data)
+            data["state"] = json.dumps(state, ensure_ascii=False)
+            data["system_id"] = jsondata["SystemAddress"]
+            data["updated_at"] = jsondata["timestamp"]
+            executeUpsert("system_faction_tbl", data)
 
 def mergeLocalizedArray(jsonarray:list):
     for item in jsonarray:
@@ -467,43 +1782,141 @@ def mergeLocalized(jsondata:dict) -> dict:
     return jsondata
 
 def updateStatistics(jsondata:dict):
-    KEY_STATISTICS = {"timestamp":"updated_at"}
     LIST_STATISTICS_DETAIL = ['Bank_Account', 'Combat', 'Crime', 'Smuggling', 'Trading', 'Mining', 'Exploration', 'Passengers', 'Search_And_Rescue', 'Squadron', 'Crafting', 'Crew', 'Multicrew', 'Material_Trader_Stats', 'Exobiology']
 
-    data = {k:v for k,v in jsondata.items() if k in KEY_STATISTICS and v != ""}
     detail = {k:v for k,v in jsondata.items() if k in LIST_STATISTICS_DETAIL and v != ""}
 
     if len(detail) > 0:
-        data['detail'] = json.dumps(detail, ensure_ascii=False)
-
-        tmp1 = "INSERT INTO statistics_tbl(updated_at,"
-        tmp2 = " VALUES(:timestamp,"
-        tmp3 = " ON CONFLICT(updated_at) DO UPDATE SET"
-        for k,v in data.items():
-            match k:
-                case "timestamp":
-                    pass
-                case "detail":
-                    tmp1 += f" detail,"
-                    tmp2 += f" jsonb(:detail),"
-                    tmp3 += f" detail=jsonb_patch(detail, excluded.detail),"
-                case _:
-                    tmp1 += f" {KEY_STATISTICS[k]},"
-                    tmp2 += f" :{k},"
-                    tmp3 += f" {KEY_STATISTICS[k]}=excluded.{KEY_STATISTICS[k]},"
-        query = re.sub(',$',') ',tmp1) + re.sub(',$',') ',tmp2) + re.sub(',$',';',tmp3)
-        logger.debug(query)
-        db = getConnection()
-        cur = db.cursor()
-        cur.execute(query,data)
-        cur.close()
+        data = {"updated_at": jsondata["timestamp"], "detail": json.dumps(detail, ensure_ascii=False)}
+        executeUpsert("statistics_tbl", data)
+
+
+# Exploration queries
+#  Filters on the generated columns of body_tbl and on body_material_tbl,
+#  so they are answered from indexes instead of decoding detail blobs.
+def findBodies(planetclass:str=None, landable:bool=None, terraformable:bool=None, maxdistancels:float=None, material:str=None, minpercent:float=0) -> List[tuple]:
+    """Bodies matching all given filters as
+    (system_id, body_id, name, planetclass, distancefromarrivalls), nearest to arrival first."""
+    terms = []
+    params = []
+    if planetclass is not None:
+        terms.append("b.planetclass=?")
+        params.append(planetclass)
+    if landable is not None:
+        terms.append("b.landable=?")
+        params.append(int(landable))
+    if terraformable is not None:
+        terms.append("b.terraformstate IS 'Terraformable'" if terraformable else "b.terraformstate IS NOT 'Terraformable'")
+    if maxdistancels is not None:
+        terms.append("b.distancefromarrivalls<=?")
+        params.append(maxdistancels)
+    query = "SELECT b.system_id, b.body_id, b.name, b.planetclass, b.distancefromarrivalls FROM body_tbl AS b"
+    if material is not None:
+        query = "SELECT b.system_id, b.body_id, b.name, b.planetclass, b.distancefromarrivalls FROM body_material_tbl AS m JOIN body_tbl AS b ON b.system_id=m.system_id AND b.body_id=m.body_id"
+        terms.insert(0, "m.material=? AND m.percent>=?")
+        params[0:0] = [material, minpercent]
+    if terms:
+        query += " WHERE " + " AND ".join(terms)
+    query += " ORDER BY b.distancefromarrivalls"
+    return queryAll(query, params)
+
+def getBodiesWithMaterial(material:str, minpercent:float=0) -> List[tuple]:
+    """Bodies holding a material as (system_id, body_id, name, percent), richest first."""
+    return queryAll("SELECT m.system_id, m.body_id, b.name, m.percent FROM body_material_tbl AS m LEFT JOIN body_tbl AS b ON b.system_id=m.system_id AND b.body_id=m.body_id WHERE m.material=? AND m.percent>=? ORDER BY m.percent DESC", (material, minpercent))
+
+
+# System trees
+#  Answered from body_ancestor_tbl with a single indexed query each. Barycentres
+#  and bodies not scanned yet appear as ancestors only, with name None.
+def getBodySubtree(system_id:int, body_id:int, maxdepth:int=None) -> List[tuple]:
+    """Bodies orbiting body_id directly or indirectly as (body_id, name, depth below body_id),
+    e.g. the moons of a planet or everything around a barycentre, nearest levels first."""
+    query = "SELECT a.body_id, b.name, a.depth FROM body_ancestor_tbl AS a LEFT JOIN body_tbl AS b ON b.system_id=a.system_id AND b.body_id=a.body_id WHERE a.system_id=? AND a.ancestor_id=?"
+    params = [system_id, body_id]
+    if maxdepth is not None:
+        query += " AND a.depth<=?"
+        params.append(maxdepth)
+    query += " ORDER BY a.depth, a.body_id"
+    return queryAll(query, params)
+
+def getBodyAncestors(system_id:int, body_id:int) -> List[tuple]:
+    """Bodies body_id orbits as (ancestor_id, name, depth, orbittype), from the direct parent up."""
+    return queryAll("SELECT a.ancestor_id, b.name, a.depth, a.orbittype FROM body_ancestor_tbl AS a LEFT JOIN body_tbl AS b ON b.system_id=a.system_id AND b.body_id=a.ancestor_id WHERE a.system_id=? AND a.body_id=? ORDER BY a.depth", (system_id, body_id))
+
+def getBodySiblings(system_id:int, body_id:int) -> List[tuple]:
+    """Other bodies orbiting the direct parent of body_id as (body_id, name)."""
+    return queryAll("SELECT s.body_id, b.name FROM body_ancestor_tbl AS s LEFT JOIN body_tbl AS b ON b.system_id=s.system_id AND b.body_id=s.body_id WHERE s.system_id=:system_id AND s.ancestor_id=(SELECT ancestor_id FROM body_ancestor_tbl WHERE system_id=:system_id AND body_id=:body_id AND depth=1) AND s.depth=1 AND s.body_id<>:body_id ORDER BY s.body_id", {"system_id": system_id, "body_id": body_id})
+
+def getSystemTree(system_id:int) -> List[tuple]:
+    """Edges of the body tree of a system as (body_id, name, parent_id, orbittype of the parent)."""
+    return queryAll("SELECT a.body_id, b.name, a.ancestor_id, a.orbittype FROM body_ancestor_tbl AS a LEFT JOIN body_tbl AS b ON b.system_id=a.system_id AND b.body_id=a.body_id WHERE a.system_id=? AND a.depth=1 ORDER BY a.ancestor_id, a.body_id", (system_id,))
+
+
+# Spatial queries
+#  system_rtree narrows a query down to a bounding box; exact distances are
+#  then computed from system_tbl positions. Nearest-neighbour queries grow the
+#  search radius until k results lie within it.
+NEAREST_INITIAL_RADIUS = 20.0
+NEAREST_MAX_RADIUS = 100000.0
+
+QUERY_SYSTEM_IN_BOX = "SELECT s.id, s.name, s.posx, s.posy, s.posz FROM system_rtree AS r CROSS JOIN system_tbl AS s ON s.id=r.id WHERE r.maxx>=:minx AND r.minx<=:maxx AND r.maxy>=:miny AND r.miny<=:maxy AND r.maxz>=:minz AND r.minz<=:maxz"
+
+QUERY_SYSTEM_IN_RADIUS = "SELECT s.id, s.name, (s.posx-:x)*(s.posx-:x)+(s.posy-:y)*(s.posy-:y)+(s.posz-:z)*(s.posz-:z) AS dist2 FROM system_rtree AS r CROSS JOIN system_tbl AS s ON s.id=r.id WHERE r.maxx>=:x-:r AND r.minx<=:x+:r AND r.maxy>=:y-:r AND r.miny<=:y+:r AND r.maxz>=:z-:r AND r.minz<=:z+:r AND dist2<=:r*:r ORDER BY dist2 LIMIT :k"
+
+QUERY_MARKET_SELLING_IN_RADIUS = "SELECT m.id, m.name, s.id, s.name, p.buyprice, p.stock, (s.posx-:x)*(s.posx-:x)+(s.posy-:y)*(s.posy-:y)+(s.posz-:z)*(s.posz-:z) AS dist2 FROM system_rtree AS r CROSS JOIN system_tbl AS s ON s.id=r.id JOIN market_tbl AS m ON m.system_id=s.id JOIN market_price_tbl AS p ON p.market_id=m.id WHERE p.commodity_id=(SELECT id FROM commodity_tbl WHERE name=:commodity) AND p.stock>=:minstock AND p.buyprice>0 AND r.maxx>=:x-:r AND r.minx<=:x+:r AND r.maxy>=:y-:r AND r.miny<=:y+:r AND r.maxz>=:z-:r AND r.minz<=:z+:r AND dist2<=:r*:r ORDER BY dist2 LIMIT :k"
+
+def getSystemPos(system) -> Tuple[float, float, float]:
+    """Position of a system given by name or SystemAddress, None if unknown."""
+    column = "id" if isinstance(system, int) else "name"
+    return queryOne(f"SELECT posx, posy, posz FROM system_tbl WHERE {column}=? AND posx IS NOT NULL", (system,))
+
+def getSystemsInBox(minpos:Tuple[float, float, float], maxpos:Tuple[float, float, float]) -> List[tuple]:
+    """Systems inside a bounding box as (id, name, posx, posy, posz)."""
+    params = dict(zip(("minx", "miny", "minz", "maxx", "maxy", "maxz"), (*minpos, *maxpos)))
+    return queryAll(QUERY_SYSTEM_IN_BOX, params)
+
+def getSystemsWithinRadius(pos:Tuple[float, float, float], radius:float) -> List[tuple]:
+    """Systems within radius ly of pos as (id, name, distance), nearest first."""
+    x, y, z = pos
+    rows = queryAll(QUERY_SYSTEM_IN_RADIUS, {"x": x, "y": y, "z": z, "r": radius, "k": -1})
+    return [(id, name, math.sqrt(dist2)) for id, name, dist2 in rows]
+
+def getNearestSystems(pos:Tuple[float, float, float], k:int=10, maxradius:float=NEAREST_MAX_RADIUS) -> List[tuple]:
+    """k nearest visited systems as (id, name, distance), nearest first."""
+    rows = searchNearest(QUERY_SYSTEM_IN_RADIUS, {}, pos, k, maxradius)
+    return [(id, name, math.sqrt(dist2)) for id, name, dist2 in rows]
+
+def getNearestMarketsSelling(commodity:str, pos:Tuple[float, float, float], k:int=10, minstock:int=1, maxradius:float=NEAREST_MAX_RADIUS) -> List[tuple]:
+    """k nearest markets selling a commodity as
+    (market_id, market name, system_id, system name, buyprice, stock, distance)."""
+    rows = searchNearest(QUERY_MARKET_SELLING_IN_RADIUS, {"commodity": commodity, "minstock": minstock}, pos, k, maxradius)
+    return [(*row[:-1], math.sqrt(row[-1])) for row in rows]
+
+def searchNearest(query:str, params:dict, pos:Tuple[float, float, float], k:int, maxradius:float) -> List[tuple]:
+    """Run a radius query with a growing radius until it holds k rows."""
+    x, y, z = pos
+    radius = NEAREST_INITIAL_RADIUS
+    with readConnection() as conn:
+        while True:
+            radius = min(radius, maxradius)
+            rows = conn.execute(query, {**params, "x": x, "y": y, "z": z, "r": radius, "k": k}).fetchall()
+            if len(rows) >= k or radius >= maxradius:
+                return rows
+            radius *= 2
 
 
 def getEdLogList(dir:str):
+    """Journals below dir in journal order. A journal kept both plain and
+    compressed is read from the plain file, which the game may still write."""
     p = Path(dir)
-    edlogs = list(p.glob('**/*.log'))
-    edlogs.sort()
-    return edlogs
+    edlogs = {}
+    for suffix in ["", *JOURNAL_DECOMPRESSOR]:
+        for path in p.glob(f'**/*.log{suffix}'):
+            if suffix == ".zst" and zstandard is None:
+                logger.error(f"zstandard is not installed, skip {path}")
+                continue
+            edlogs.setdefault(getPlainJournal(path), path)
+    return [edlogs[path] for path in sorted(edlogs)]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,250 @@
+# Trade route finder for ED_PersonalLogbook
+#  Loads the latest market prices and system positions from the logger
+#  database into NumPy arrays and searches all market pairs for the most
+#  profitable single hops and round trips.
+#
+#  python traderoute.py --max-distance 40 --pad L --max-age 48 --top 10
+#  python traderoute.py --round-trip
+
+import os
+import time
+import argparse
+from typing import List, NamedTuple, Tuple
+
+import numpy as np
+
+import logger as edlog
+
+# smallest landing pad a ship needs, compared with the largest pad of a market
+PAD_SIZE = {"S": 1, "M": 2, "L": 3}
+
+# upper bound of profit cells (source markets x target markets x commodities)
+# computed at once; sources are processed in blocks of this size
+BLOCK_CELLS = 1 << 22
+
+# changes whenever a price, market or system position changes, a market is
+# read again, or a market or commodity is added; the max() terms are answered
+# from the updated_at and seen_at indexes
+QUERY_TRADE_VERSION = "SELECT (SELECT max(updated_at) FROM market_price_tbl), (SELECT max(seen_at) FROM market_seen_tbl), (SELECT max(updated_at) FROM market_tbl), (SELECT max(updated_at) FROM system_tbl), (SELECT COUNT(*) FROM market_tbl), (SELECT COUNT(*) FROM commodity_tbl)"
+
+QUERY_TRADE_MARKET = "SELECT m.id, m.name, s.name, s.posx, s.posy, s.posz, CASE WHEN m.padl>0 THEN 3 WHEN m.padm>0 THEN 2 WHEN m.pads>0 THEN 1 ELSE 0 END, coalesce(v.seen_at, 0) FROM market_tbl AS m JOIN system_tbl AS s ON s.id=m.system_id LEFT JOIN market_seen_tbl AS v ON v.market_id=m.id WHERE s.posx IS NOT NULL ORDER BY m.id"
+
+QUERY_TRADE_PRICE = "SELECT p.market_id, p.commodity_id, p.buyprice, p.sellprice, p.stock, p.demand FROM market_price_tbl AS p JOIN market_tbl AS m ON m.id=p.market_id JOIN system_tbl AS s ON s.id=m.system_id WHERE s.posx IS NOT NULL"
+
+class TradeData(NamedTuple):
+    """Latest prices as markets x commodities matrices. Market rows follow market_id order.
+    seen_at is the time each market's prices were last read."""
+    version: tuple
+    market_id: np.ndarray
+    market_name: List[str]
+    system_name: List[str]
+    pos: np.ndarray
+    padsize: np.ndarray
+    seen_at: np.ndarray
+    commodity_name: List[str]
+    buyprice: np.ndarray
+    sellprice: np.ndarray
+    stock: np.ndarray
+    demand: np.ndarray
+
+class TradeRoute(NamedTuple):
+    src_market_id: int
+    src_market: str
+    src_system: str
+    dst_market_id: int
+    dst_market: str
+    dst_system: str
+    distance: float
+    commodity: str
+    buyprice: int
+    sellprice: int
+    profit: int
+
+class RoundTrip(NamedTuple):
+    outbound: TradeRoute
+    inbound: TradeRoute
+    profit: int
+
+def loadTradeData() -> TradeData:
+    """Read markets, positions and prices from one snapshot of the database."""
+    with edlog.readConnection() as conn:
+        conn.execute("BEGIN")
+        version = conn.execute(QUERY_TRADE_VERSION).fetchone()
+        markets = conn.execute(QUERY_TRADE_MARKET).fetchall()
+        commodities = conn.execute("SELECT id, name FROM commodity_tbl ORDER BY id").fetchall()
+        prices = conn.execute(QUERY_TRADE_PRICE).fetchall()
+
+    market_id = np.array([row[0] for row in markets], dtype=np.int64)
+    commodity_id = np.array([row[0] for row in commodities], dtype=np.int64)
+    shape = (len(markets), len(commodities))
+    buyprice = np.zeros(shape, dtype=np.float32)
+    sellprice = np.zeros(shape, dtype=np.float32)
+    stock = np.zeros(shape, dtype=np.int32)
+    demand = np.zeros(shape, dtype=np.int32)
+    if prices:
+        price = np.array(prices, dtype=np.float64)
+        price = np.nan_to_num(price)
+        rows = np.searchsorted(market_id, price[:, 0].astype(np.int64))
+        cols = np.searchsorted(commodity_id, price[:, 1].astype(np.int64))
+        buyprice[rows, cols] = price[:, 2]
+        sellprice[rows, cols] = price[:, 3]
+        stock[rows, cols] = price[:, 4]
+        demand[rows, cols] = price[:, 5]
+
+    return TradeData(
+        version=version,
+        market_id=market_id,
+        market_name=[row[1] for row in markets],
+        system_name=[row[2] for row in markets],
+        pos=np.array([row[3:6] for row in markets], dtype=np.float64).reshape(-1, 3),
+        padsize=np.array([row[6] for row in markets], dtype=np.int8),
+        seen_at=np.array([row[7] for row in markets], dtype=np.int64),
+        commodity_name=[row[1] for row in commodities],
+        buyprice=buyprice,
+        sellprice=sellprice,
+        stock=stock,
+        demand=demand,
+    )
+
+_tradeData = None
+def getTradeData() -> TradeData:
+    """Cached TradeData, reloaded once prices or markets changed."""
+    global _tradeData
+    if _tradeData is None or _tradeData.version != edlog.queryOne(QUERY_TRADE_VERSION):
+        _tradeData = loadTradeData()
+    return _tradeData
+
+def getTradeMatrix(data:TradeData, padsize:str, maxage:float) -> Tuple:
+    """Buy cost (+inf where nothing to buy) and sell gain (-inf where nothing
+    to sell) per market and commodity, for usable markets with fresh prices."""
+    usable = (data.padsize >= PAD_SIZE[padsize])[:, None]
+    if maxage is not None:
+        usable = usable & (data.seen_at >= time.time() - maxage)[:, None]
+    buy = np.where(usable & (data.stock > 0) & (data.buyprice > 0), data.buyprice, np.inf).astype(np.float32)
+    sell = np.where(usable & (data.demand > 0) & (data.sellprice > 0), data.sellprice, -np.inf).astype(np.float32)
+    return buy, sell
+
+def bestCommodity(buy:np.ndarray, sell:np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Best profit per ton and its commodity for every (buy market, sell market) pair."""
+    profit = sell[None, :, :] - buy[:, None, :]
+    commodity = profit.argmax(axis=2)
+    return np.take_along_axis(profit, commodity[:, :, None], axis=2)[:, :, 0], commodity
+
+def getDistance(pos:np.ndarray, src:np.ndarray, dst:np.ndarray) -> np.ndarray:
+    return np.sqrt(((pos[src][:, None, :] - pos[dst][None, :, :]) ** 2).sum(axis=2))
+
+def takeTop(score:np.ndarray, top:int) -> np.ndarray:
+    """Flat indexes of the top positive scores, best first."""
+    flat = score.ravel()
+    k = min(top, int((flat > 0).sum()))
+    if k == 0:
+        return np.empty(0, dtype=np.int64)
+    idx = np.argpartition(-flat, k - 1)[:k]
+    return idx[np.argsort(-flat[idx], kind="stable")]
+
+def blockSize(targets:int, commodities:int) -> int:
+    return max(1, BLOCK_CELLS // max(1, targets * commodities))
+
+def makeRoute(data:TradeData, src:int, dst:int, commodity:int, distance:float) -> TradeRoute:
+    buyprice = int(data.buyprice[src, commodity])
+    sellprice = int(data.sellprice[dst, commodity])
+    return TradeRoute(int(data.market_id[src]), data.market_name[src], data.system_name[src], int(data.market_id[dst]), data.market_name[dst], data.system_name[dst], float(distance), data.commodity_name[commodity], buyprice, sellprice, sellprice - buyprice)
+
+def findTradeRoutes(maxdistance:float=None, padsize:str="S", maxage:float=None, top:int=10, data:TradeData=None) -> List[TradeRoute]:
+    """Most profitable single hops: buy one commodity at a market and sell it
+    at another within maxdistance ly, using markets read within the last maxage seconds."""
+    data = data or getTradeData()
+    buy, sell = getTradeMatrix(data, padsize, maxage)
+    src = np.flatnonzero(np.isfinite(buy).any(axis=1))
+    dst = np.flatnonzero(np.isfinite(sell).any(axis=1))
+    if len(src) == 0 or len(dst) == 0:
+        return []
+
+    candidates = []
+    step = blockSize(len(dst), buy.shape[1])
+    for start in range(0, len(src), step):
+        block = src[start:start + step]
+        profit, commodity = bestCommodity(buy[block], sell[dst])
+        distance = getDistance(data.pos, block, dst)
+        profit[block[:, None] == dst[None, :]] = -np.inf
+        if maxdistance is not None:
+            profit[distance > maxdistance] = -np.inf
+        for idx in takeTop(profit, top):
+            i, j = divmod(int(idx), len(dst))
+            candidates.append((float(profit[i, j]), block[i], dst[j], commodity[i, j], distance[i, j]))
+
+    candidates.sort(key=lambda c: -c[0])
+    return [makeRoute(data, i, j, c, d) for _, i, j, c, d in candidates[:top]]
+
+def findRoundTrips(maxdistance:float=None, padsize:str="S", maxage:float=None, top:int=10, data:TradeData=None) -> List[RoundTrip]:
+    """Most profitable pairs of markets trading in both directions, by the sum
+    of the best profit per ton of each leg."""
+    data = data or getTradeData()
+    buy, sell = getTradeMatrix(data, padsize, maxage)
+    markets = np.flatnonzero(np.isfinite(buy).any(axis=1) & np.isfinite(sell).any(axis=1))
+    if len(markets) < 2:
+        return []
+
+    candidates = []
+    step = blockSize(2 * len(markets), buy.shape[1])
+    for start in range(0, len(markets), step):
+        block = markets[start:start + step]
+        outbound, outcommodity = bestCommodity(buy[block], sell[markets])
+        inbound, incommodity = bestCommodity(buy[markets], sell[block])
+        inbound, incommodity = inbound.T, incommodity.T
+        distance = getDistance(data.pos, block, markets)
+        # each pair once, and both legs must pay
+        profit = np.where((outbound > 0) & (inbound > 0) & (block[:, None] < markets[None, :]), outbound + inbound, -np.inf)
+        if maxdistance is not None:
+            profit[distance > maxdistance] = -np.inf
+        for idx in takeTop(profit, top):
+            i, j = divmod(int(idx), len(markets))
+            candidates.append((float(profit[i, j]), block[i], markets[j], outcommodity[i, j], incommodity[i, j], distance[i, j]))
+
+    candidates.sort(key=lambda c: -c[0])
+    trips = []
+    for _, i, j, out, back, d in candidates[:top]:
+        outroute = makeRoute(data, i, j, out, d)
+        inroute = makeRoute(data, j, i, back, d)
+        trips.append(RoundTrip(outroute, inroute, outroute.profit + inroute.profit))
+    return trips
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ED_PersonalLogbook trade route finder")
+    parser.add_argument("--max-distance", type=float, default=None, help="max distance between the systems in ly")
+    parser.add_argument("--pad", choices=list(PAD_SIZE), default="S", help="landing pad size the ship needs")
+    parser.add_argument("--max-age", type=float, default=None, help="ignore markets not read within this many hours")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--round-trip", action="store_true", help="search round trips instead of single hops")
+    args = parser.parse_args()
+
+    maxage = args.max_age * 3600 if args.max_age is not None else None
+    if not os.path.exists(edlog.DB_NAME):
+        parser.error(f"{edlog.DB_NAME} not found, import journals with logger.py first")
+    # tables added later are created by the writer, which this tool never opens
+    if edlog.queryOne("SELECT COUNT(*) FROM sqlite_master WHERE name='market_seen_tbl'")[0] == 0:
+        parser.error(f"{edlog.DB_NAME} is out of date, run logger.py once to update it")
+    t0 = time.perf_counter()
+    data = getTradeData()
+    t1 = time.perf_counter()
+    if args.round_trip:
+        trips = findRoundTrips(args.max_distance, args.pad, maxage, args.top, data)
+        routes = None
+    else:
+        routes = findTradeRoutes(args.max_distance, args.pad, maxage, args.top, data)
+    t2 = time.perf_counter()
+
+    print(f"{len(data.market_id)} markets x {len(data.commodity_name)} commodities, load {t1 - t0:.3f} s, search {t2 - t1:.3f} s")
+    if routes is not None:
+        for r in routes:
+            print(f"{r.profit:6} cr/t  {r.commodity:30} {r.src_market} ({r.src_system}) -> {r.dst_market} ({r.dst_system}), {r.distance:.1f} ly")
+    else:
+        for trip in trips:
+            out, back = trip.outbound, trip.inbound
+            print(f"{trip.profit:6} cr/t  {out.src_market} ({out.src_system}) <-> {out.dst_market} ({out.dst_system}), {out.distance:.1f} ly: {out.commodity} / {back.commodity}")
+    edlog.closeReadConnections()
+
+
+if __name__ == "__main__":
+    main()